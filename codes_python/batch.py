@@ -0,0 +1,115 @@
+# import external modules
+
+from time import time
+
+t_start = time()
+
+import concurrent.futures
+import sys
+import os
+from copy import deepcopy
+
+# import internal modules
+from utils import run_options
+from utils.frame import Frame
+from processing import run_parallel
+from processing.run_frame import run_frame
+
+# batch of frames processed in one process: python3 batch.py [main.py options] frames...
+# frames are FITS files, directories, glob patterns or @files with one path per line,
+# -O is the output directory, results of a frame are named by the frame as with main.py -O <dir>/<frame>
+cfg, args, frames = run_options.read_batch_arguments()
+
+if len(frames) == 0:
+    print('No input frames')
+    sys.exit(1)
+
+output_dir = cfg.output if args.output is not None else os.path.dirname(cfg.output)
+if output_dir:
+    os.makedirs(output_dir, exist_ok=True)
+
+# the worker pool is created once and kept warm for all frames
+executor = None
+if cfg.parallel > 1 or cfg.workers is not None or cfg.tile_size is not None:
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=run_parallel.pool_size(cfg))
+
+
+
+def failed_reports(wait=False):
+    # frames of the background reports that failed (after their catalogs were written), all reports finish with WAIT
+    if cfg.report != 'background':
+        return []
+
+    from utils import report
+    if wait:
+        report.wait_reports()
+
+    frames = []
+    for filename, error in report.take_report_errors():
+        print(f'Report of {filename} failed: {error}')
+        frames.append(filename)
+    return frames
+
+
+processed, failed, names = 0, [], set()
+t_frames = time()
+try:
+    for filename in frames:
+        t_init = time()
+        print(f'\n========= {filename} =========\n')
+
+        frame_cfg = deepcopy(cfg)
+        frame_cfg.input = filename
+
+        # frames of the same name from different directories are numbered
+        name = base = os.path.splitext(os.path.basename(filename))[0]
+        k = 0
+        while name in names:
+            k += 1
+            name = f'{base}_{k}'
+        names.add(name)
+        frame_cfg.output = os.path.join(output_dir, name)
+
+        try:
+            frame = Frame(filename)
+        except Exception as e:
+            print(f'Cannot open {filename}: {e}')
+            failed.append(filename)
+            continue
+
+        try:
+            missing = run_options.read_frame_arguments(frame_cfg, args, frame)
+            if missing:
+                for field in missing:
+                    print(f'Missing input parameter {field}')
+                failed.append(filename)
+                continue
+
+            run_frame(frame_cfg, frame, t_init, executor=executor)
+            processed += 1
+        except Exception as e:
+            print(f'Processing of {filename} failed: {e}')
+            failed.append(filename)
+        finally:
+            frame.close()
+
+        # reports of earlier frames finish while this frame is processed
+        reports = failed_reports()
+        processed -= len(reports)
+        failed += reports
+finally:
+    reports = failed_reports(wait=True)
+    processed -= len(reports)
+    failed += reports
+    if executor is not None:
+        executor.shutdown()
+
+t_end = time()
+
+print("\n------- Batch ---------\n")
+print(f'Processed frames : {processed} of {len(frames)}')
+for filename in failed:
+    print(f'   Failed        : {filename}')
+print(f'Startup time     : {t_frames - t_start:.4f} sec')
+print(f'Processing time  : {t_end - t_frames:.4f} sec')
+print(f'Throughput       : {processed / max(t_end - t_frames, 1e-9) * 60:.2f} frames/min')
@@ -1,6 +1,6 @@
-from processing.getPixels import get_pixels
+from processing.getPixels import get_pixels, get_pixels_batch, get_box_bounds
 import numpy as np
-from utils.structures import GravityCentreResult
+from utils.structures import GravityCentreResult, GravityCentreBatchResult
 
 
 def find_gravity_centre(cent_x, cent_y, A, B, alpha, image, pix_prop, bckg=0):
@@ -55,6 +55,80 @@ def find_gravity_centre(cent_x, cent_y, A, B, alpha, image, pix_prop, bckg=0):
 
     return GravityCentreResult( center=((sum_Gx/sum_G), (sum_Gy/sum_G)), X_pixels=data_X, Y_pixels=data_Y, Z_pixels=data_Z )
 
+def find_gravity_centres(cent_x, cent_y, A, B, alpha, image, pix_prop, bckg=0, integral=None):
+
+    # find_gravity_centre for many boxes at once, CENT_X and CENT_Y are arrays of box centres
+    # box sums are accumulated per box with bincount, centres of empty boxes are NaN
+    # INTEGRAL (IntegralImage) is used for axis aligned boxes when all pixels are used,
+    # such boxes are marked in SUMMED and their pixels are not extracted
+
+    cent_x = np.asarray(cent_x, dtype=float).reshape(-1)
+    cent_y = np.asarray(cent_y, dtype=float).reshape(-1)
+
+    n = len(cent_x)
+    center_x = np.full(n, np.nan)
+    center_y = np.full(n, np.nan)
+    count = np.zeros(n, dtype=int)
+    sum_Z = np.zeros(n)
+    summed = np.zeros(n, dtype=bool)
+
+    if integral is not None and alpha == 0 and pix_prop == 100 and bckg == 0:
+        x_lef, x_rig, y_bot, y_top, regular = get_box_bounds(cent_x, cent_y, A, B, *image.shape[:2])
+        summed = regular & integral.covers(x_lef, x_rig, y_bot, y_top)
+
+        box = (x_lef[summed], x_rig[summed], y_bot[summed], y_top[summed])
+        sum_G, sum_Gx, sum_Gy = integral.box_sums(*box)
+
+        count[summed] = (box[1] - box[0] + 1) * (box[3] - box[2] + 1)
+        sum_Z[summed] = sum_G
+        with np.errstate(divide='ignore', invalid='ignore'):
+            center_x[summed] = sum_Gx / sum_G
+            center_y[summed] = sum_Gy / sum_G
+
+    rest = np.flatnonzero(np.logical_not(summed))
+
+    data_X, data_Y, data_Z, index = get_pixels_batch(cent_x[rest], cent_y[rest], A, B, alpha, image)
+
+    m = len(rest)
+    count_rest = np.bincount(index, minlength=m)
+
+    x, y, z, idx = data_X, data_Y, data_Z, index
+
+    if pix_prop != 100:
+        # centroiding from PIXPROP pixels, boxes sorted by brightness (stable as in find_gravity_centre)
+        order = np.lexsort((-data_Z, index))
+        start = np.cumsum(count_rest) - count_rest
+        threshold = np.floor(count_rest * pix_prop / 100).astype(int)
+
+        min_val = np.full(m, np.inf)
+        filled = count_rest > 0
+        min_val[filled] = data_Z[order][start[filled] + threshold[filled]]
+
+        keep = order[data_Z[order] > min_val[index[order]]]
+        x, y, z, idx = data_X[keep], data_Y[keep], data_Z[keep], index[keep]
+
+    if bckg != 0:
+        # this is to avoid unnecessary subtractions when BCKG == 0
+        z = z - bckg
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sum_G = np.bincount(idx, weights=z, minlength=m)
+        sum_Gx = np.bincount(idx, weights=z * (x - 0.5), minlength=m)
+        sum_Gy = np.bincount(idx, weights=z * (y - 0.5), minlength=m)
+
+        center_x[rest] = np.where(count_rest > 0, sum_Gx / sum_G, np.nan)
+        center_y[rest] = np.where(count_rest > 0, sum_Gy / sum_G, np.nan)
+
+    if pix_prop == 100 and bckg != 0:
+        data_Z = z
+
+    count[rest] = count_rest
+    sum_Z[rest] = np.bincount(index, weights=data_Z, minlength=m)
+
+    return GravityCentreBatchResult(center_x=center_x, center_y=center_y, count=count, sum_Z=sum_Z, summed=summed,
+                                    X_pixels=data_X, Y_pixels=data_Y, Z_pixels=data_Z, index=rest[index])
+
+
 if __name__ == "__main__":
 
     pixlim = 22
@@ -1,7 +1,284 @@
+from functools import lru_cache
 import numpy as np
 
+# number of (A, B, alpha) stencils kept in memory
+STENCIL_CACHE_SIZE = 4096
+
 
 def get_pixels(cent_x, cent_y, A, B, alpha, image):
+    # pixels of the box centred at CENT with length 2*A and width 2*B rotated by ALPHA
+    # boxes at integer centres (sweep seeds) far enough from the image border are gathered with a cached
+    # stencil, other boxes are rasterized (sub-pixel centres would almost never hit the cache)
+
+    nrow, ncol = image.shape[:2]
+
+    if not (np.isfinite(cent_x) and np.isfinite(cent_y)):  # no centre (e.g. a box with zero sum), no pixels
+        return np.array([]), np.array([]), np.array([])
+
+    base_x = int(np.floor(cent_x))
+    base_y = int(np.floor(cent_y))
+
+    if base_x != cent_x or base_y != cent_y or not box_inside_image(cent_x, cent_y, A, B, alpha, nrow, ncol):
+        return rasterize_box(cent_x, cent_y, A, B, alpha, image)
+
+    offset_x, offset_y = get_box_stencil(A, B, alpha)
+
+    X_pixels = offset_x + base_x
+    Y_pixels = offset_y + base_y
+    Z_pixels = image[Y_pixels, X_pixels].astype(float)
+
+    return X_pixels.astype(float), Y_pixels.astype(float), Z_pixels
+
+
+def box_inside_image(cent_x, cent_y, A, B, alpha, nrow, ncol):
+    # True if the box (with one pixel of reserve) does not reach the image border
+    half_x = abs(A * np.cos(alpha)) + abs(B * np.sin(alpha))
+    half_y = abs(A * np.sin(alpha)) + abs(B * np.cos(alpha))
+
+    return cent_x - half_x >= 2 and cent_x + half_x <= ncol - 3 and \
+           cent_y - half_y >= 2 and cent_y + half_y <= nrow - 3
+
+
+@lru_cache(maxsize=STENCIL_CACHE_SIZE)
+def get_box_stencil(A, B, alpha):
+    # pixel offsets of the box relative to its integer centre,
+    # the box is rasterized once on an empty canvas large enough to avoid clipping
+
+    margin = int(np.ceil(A + B)) + 4
+    canvas = np.zeros((2 * margin + 2, 2 * margin + 2))
+
+    X, Y, _ = rasterize_box(margin, margin, A, B, alpha, canvas)
+
+    offset_x = X.astype(int) - margin
+    offset_y = Y.astype(int) - margin
+    offset_x.setflags(write=False)
+    offset_y.setflags(write=False)
+
+    return offset_x, offset_y
+
+
+def rasterize_box(cent_x, cent_y, A, B, alpha, image):
+    # borders of all pixel rows are computed in one vectorized step and the pixels
+    # are written into preallocated arrays, the pixel set (and order) is the same
+    # as the one produced by the row by row walk in rasterize_box_rows
+
+    X_pixels = np.array([])
+    Y_pixels = np.array([])
+    Z_pixels = np.array([])
+
+    nrow, ncol = image.shape[:2]
+
+    vecR = np.array([cent_x, cent_y])
+    vecA = np.array([A * np.cos(alpha), A * np.sin(alpha)])
+    vecB = np.array([B * np.cos(alpha + np.pi / 2), B * np.sin(alpha + np.pi / 2)])
+    # four corners of the box
+    TL = vecR - vecA + vecB
+    TR = vecR + vecA + vecB
+    BL = vecR - vecA - vecB
+    BR = vecR + vecA - vecB
+
+    if 89 < abs(alpha*180 / np.pi) % 90 > 1:
+        # intersections of the horizontal lines with the four bounding lines, middle two are kept
+        tgA = np.tan(alpha)
+        tgA2 = np.tan(alpha + np.pi / 2)
+        slopes = np.array([tgA, tgA, tgA2, tgA2])
+        shifts = np.array([TR[1] - tgA * TR[0], BL[1] - tgA * BL[0], BL[1] - tgA2 * BL[0], TR[1] - tgA2 * TR[0]])
+
+        def compute_x_on_lines(lines):
+            x = (lines.reshape(-1, 1) - shifts) / slopes
+            return np.sort(x, axis=1)[:, 1:3]
+    else:
+        x_box = np.sort([BL[0], TR[0]])
+
+        def compute_x_on_lines(lines):
+            return np.tile(x_box, (len(lines), 1))
+
+    def get_left_right_x(lines_top, lines_bot):
+        x_top = np.round(compute_x_on_lines(lines_top), 6)  # this is needed because of numerical instability of ceil
+        x_bot = np.round(compute_x_on_lines(lines_bot), 6)
+        x_lef = np.ceil(np.minimum(x_top[:, 0], x_bot[:, 0])).astype(int)
+        x_rig = np.ceil(np.maximum(x_top[:, 1], x_bot[:, 1])).astype(int)
+        return x_lef, x_rig
+
+    # define box pixel borders (four lines perpendicular to axes and passing through box four corners)
+    box_top = np.floor(np.max([TL[1], TR[1], BL[1], BR[1]])).astype(int)  # first horizontal line from the top to cut the box
+    box_bot = np.ceil(np.min([TL[1], TR[1], BL[1], BR[1]])).astype(int)  # first horizontal line from the bottom to cut the box
+
+    y_first = int(min(box_top + 1, nrow - 1))
+
+    if y_first < 0:
+        return X_pixels, Y_pixels, Z_pixels
+
+    # first row is bounded by the line below it only
+    first = np.array([y_first - 1])
+    x_lef, x_rig = get_left_right_x(first, first)
+
+    if (x_lef[0] < 0 and x_rig[0] < 0) or (x_lef[0] > ncol and x_rig[0] > ncol):
+        return X_pixels, Y_pixels, Z_pixels
+
+    rows = np.array([y_first])
+    lines_top = first
+    lines_bot = first
+
+    if y_first != 0 and box_bot < nrow:
+        # intermediate rows are bounded by the lines above and below them
+        inner = np.arange(y_first - 1, max(box_bot + 1, 0) - 1, -1)
+        rows = np.concatenate((rows, inner))
+        lines_top = np.concatenate((lines_top, inner))
+        lines_bot = np.concatenate((lines_bot, inner - 1))
+
+        # last row is bounded by the last computed line
+        y_last = inner[-1] if len(inner) > 0 else y_first
+        if y_last != 0:
+            last = lines_bot[-1:]
+            rows = np.concatenate((rows, [box_bot]))
+            lines_top = np.concatenate((lines_top, last))
+            lines_bot = np.concatenate((lines_bot, last))
+
+        x_lef, x_rig = get_left_right_x(lines_top, lines_bot)
+
+    x_lef = np.clip(x_lef, 0, ncol)
+    x_rig = np.clip(x_rig, 0, ncol - 1)
+    counts = np.maximum(x_rig - x_lef + 1, 0)
+
+    # fill all rows at once
+    row_idx = np.repeat(np.arange(len(rows)), counts)
+    row_start = np.cumsum(counts) - counts
+    cols = np.arange(counts.sum()) - row_start[row_idx] + x_lef[row_idx]
+    rows = rows[row_idx]
+
+    X_pixels = cols.astype(float)
+    Y_pixels = rows.astype(float)
+    Z_pixels = image[rows, cols].astype(float)
+
+    return X_pixels, Y_pixels, Z_pixels
+
+
+def get_pixels_batch(cent_x, cent_y, A, B, alpha, image):
+    # pixels of many boxes with the same A, B and ALPHA centred at CENT_X, CENT_Y (arrays),
+    # INDEX holds the box of every pixel, pixels of one box are contiguous and the same
+    # (in the same order) as the ones returned by get_pixels for that box
+
+    cent_x = np.asarray(cent_x, dtype=float).reshape(-1)
+    cent_y = np.asarray(cent_y, dtype=float).reshape(-1)
+
+    nrow, ncol = image.shape[:2]
+
+    vecR = np.stack((cent_x, cent_y), axis=1)
+    vecA = np.array([A * np.cos(alpha), A * np.sin(alpha)])
+    vecB = np.array([B * np.cos(alpha + np.pi / 2), B * np.sin(alpha + np.pi / 2)])
+    # four corners of the boxes
+    TL = vecR - vecA + vecB
+    TR = vecR + vecA + vecB
+    BL = vecR - vecA - vecB
+    BR = vecR + vecA - vecB
+
+    if 89 < abs(alpha*180 / np.pi) % 90 > 1:
+        tgA = np.tan(alpha)
+        tgA2 = np.tan(alpha + np.pi / 2)
+        slopes = np.array([tgA, tgA, tgA2, tgA2])
+        shifts = np.stack((TR[:, 1] - tgA * TR[:, 0], BL[:, 1] - tgA * BL[:, 0],
+                           BL[:, 1] - tgA2 * BL[:, 0], TR[:, 1] - tgA2 * TR[:, 0]), axis=1)
+
+        def compute_x_on_lines(box, lines):
+            x = (lines.reshape(-1, 1) - shifts[box]) / slopes
+            return np.sort(x, axis=1)[:, 1:3]
+    else:
+        x_box = np.sort(np.stack((BL[:, 0], TR[:, 0]), axis=1), axis=1)
+
+        def compute_x_on_lines(box, lines):
+            return x_box[box]
+
+    def get_left_right_x(box, lines_top, lines_bot):
+        x_top = np.round(compute_x_on_lines(box, lines_top), 6)  # this is needed because of numerical instability of ceil
+        x_bot = np.round(compute_x_on_lines(box, lines_bot), 6)
+        x_lef = np.ceil(np.minimum(x_top[:, 0], x_bot[:, 0])).astype(int)
+        x_rig = np.ceil(np.maximum(x_top[:, 1], x_bot[:, 1])).astype(int)
+        return x_lef, x_rig
+
+    corners_y = np.stack((TL[:, 1], TR[:, 1], BL[:, 1], BR[:, 1]), axis=1)
+    box_top = np.floor(np.max(corners_y, axis=1)).astype(int)
+    box_bot = np.ceil(np.min(corners_y, axis=1)).astype(int)
+
+    boxes = np.arange(len(cent_x))
+    y_first = np.minimum(box_top + 1, nrow - 1)
+
+    # boxes above/below the image or with the first row outside of the image are empty
+    x_lef, x_rig = get_left_right_x(boxes, y_first - 1, y_first - 1)
+    empty = (y_first < 0) | ((x_lef < 0) & (x_rig < 0)) | ((x_lef > ncol) & (x_rig > ncol))
+
+    # number of intermediate rows and presence of the last row (see rasterize_box)
+    single = (y_first == 0) | (box_bot >= nrow)
+    y_end = np.maximum(box_bot + 1, 0)
+    n_inner = np.where(single, 0, np.maximum(y_first - y_end, 0))
+    y_last = np.where(n_inner > 0, y_end, y_first)
+    has_last = np.logical_not(single) & (y_last != 0)
+    n_rows = np.where(empty, 0, 1 + n_inner + has_last)
+
+    # all rows of all boxes with the pair of lines bounding each row
+    box_of_row = np.repeat(boxes, n_rows)
+    k = np.arange(n_rows.sum()) - (np.cumsum(n_rows) - n_rows)[box_of_row]
+    is_first = k == 0
+    is_last = k == n_inner[box_of_row] + 1
+
+    rows = np.where(is_first, y_first[box_of_row], y_first[box_of_row] - k)
+    rows = np.where(is_last, box_bot[box_of_row], rows)
+    lines_top = np.where(is_first, rows - 1, rows)
+    lines_top = np.where(is_last, y_last[box_of_row] - 1, lines_top)
+    lines_bot = np.where(is_first | is_last, lines_top, rows - 1)
+
+    x_lef, x_rig = get_left_right_x(box_of_row, lines_top, lines_bot)
+
+    x_lef = np.clip(x_lef, 0, ncol)
+    x_rig = np.clip(x_rig, 0, ncol - 1)
+    counts = np.maximum(x_rig - x_lef + 1, 0)
+
+    # fill all rows at once
+    row_idx = np.repeat(np.arange(len(rows)), counts)
+    row_start = np.cumsum(counts) - counts
+    cols = np.arange(counts.sum()) - row_start[row_idx] + x_lef[row_idx]
+    rows = rows[row_idx]
+
+    X_pixels = cols.astype(float)
+    Y_pixels = rows.astype(float)
+    Z_pixels = image[rows, cols].astype(float)
+
+    return X_pixels, Y_pixels, Z_pixels, box_of_row[row_idx]
+
+
+def get_box_bounds(cent_x, cent_y, A, B, nrow, ncol):
+    # pixel borders (inclusive) of axis aligned boxes (ALPHA = 0) centred at CENT_X, CENT_Y (arrays),
+    # REGULAR marks the boxes whose pixels returned by get_pixels are exactly this rectangle
+    # (box inside the image and every row present once)
+
+    cent_x = np.asarray(cent_x, dtype=float).reshape(-1)
+    cent_y = np.asarray(cent_y, dtype=float).reshape(-1)
+
+    # same arithmetic as get_pixels_batch with ALPHA = 0
+    vecR = np.stack((cent_x, cent_y), axis=1)
+    vecA = np.array([A * np.cos(0), A * np.sin(0)])
+    vecB = np.array([B * np.cos(np.pi / 2), B * np.sin(np.pi / 2)])
+    TL = vecR - vecA + vecB
+    TR = vecR + vecA + vecB
+    BL = vecR - vecA - vecB
+    BR = vecR + vecA - vecB
+
+    x_box = np.round(np.sort(np.stack((BL[:, 0], TR[:, 0]), axis=1), axis=1), 6)
+    x_lef = np.ceil(x_box[:, 0]).astype(int)
+    x_rig = np.ceil(x_box[:, 1]).astype(int)
+
+    corners_y = np.stack((TL[:, 1], TR[:, 1], BL[:, 1], BR[:, 1]), axis=1)
+    box_top = np.floor(np.max(corners_y, axis=1)).astype(int)
+    box_bot = np.ceil(np.min(corners_y, axis=1)).astype(int)
+
+    inside = (cent_x - A >= 2) & (cent_x + A <= ncol - 3) & (cent_y - B >= 2) & (cent_y + B <= nrow - 3)
+    regular = inside & (box_top >= box_bot)
+
+    return x_lef, x_rig, box_bot, box_top + 1, regular
+
+
+def rasterize_box_rows(cent_x, cent_y, A, B, alpha, image):
+    # reference implementation walking the box row by row, kept for the equivalence check
     def compute_bounding_lines(A, B, cent_x, cent_y, alpha):
         vecR = np.array([cent_x, cent_y])
         vecA = np.array([A * np.cos(alpha), A * np.sin(alpha)])
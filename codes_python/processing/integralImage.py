@@ -0,0 +1,57 @@
+import numpy as np
+
+
+class IntegralImage:
+    # summed-area tables of Z, Z*x and Z*y over a window of the image,
+    # any box sum is computed from four table values (O(1) instead of O(A*B))
+    # tables of integer images are int64 so the sums are exact
+
+    def __init__(self, image, window=None):
+        # WINDOW = (x_start, x_end, y_start, y_end) with inclusive borders, whole image by default
+        nrow, ncol = image.shape[:2]
+
+        if window is None:
+            window = (0, ncol - 1, 0, nrow - 1)
+
+        x_start, x_end, y_start, y_end = window
+        self.x_start = int(max(x_start, 0))
+        self.x_end = int(min(x_end, ncol - 1))
+        self.y_start = int(max(y_start, 0))
+        self.y_end = int(min(y_end, nrow - 1))
+
+        data = image[self.y_start:self.y_end + 1, self.x_start:self.x_end + 1]
+        dtype = np.int64 if np.issubdtype(data.dtype, np.integer) else float
+        Z = data.astype(dtype)
+
+        # coordinates are relative to the window to keep the sums small
+        x = np.arange(Z.shape[1], dtype=dtype)
+        y = np.arange(Z.shape[0], dtype=dtype).reshape(-1, 1)
+
+        self.sum_Z = self.summed_area(Z)
+        self.sum_Zx = self.summed_area(Z * x)
+        self.sum_Zy = self.summed_area(Z * y)
+
+    @staticmethod
+    def summed_area(data):
+        table = np.zeros((data.shape[0] + 1, data.shape[1] + 1), dtype=data.dtype)
+        np.cumsum(np.cumsum(data, axis=0), axis=1, out=table[1:, 1:])
+        return table
+
+    def covers(self, x_lef, x_rig, y_bot, y_top):
+        return (x_lef >= self.x_start) & (x_rig <= self.x_end) & (y_bot >= self.y_start) & (y_top <= self.y_end)
+
+    def box_sums(self, x_lef, x_rig, y_bot, y_top):
+        # sums of Z, Z*(x - 0.5) and Z*(y - 0.5) of boxes with inclusive pixel borders (arrays)
+        c0 = x_lef - self.x_start
+        c1 = x_rig - self.x_start + 1
+        r0 = y_bot - self.y_start
+        r1 = y_top - self.y_start + 1
+
+        def box(table):
+            return table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+
+        sum_G = box(self.sum_Z)
+        sum_Gx = box(self.sum_Zx) + (self.x_start - 0.5) * sum_G
+        sum_Gy = box(self.sum_Zy) + (self.y_start - 0.5) * sum_G
+
+        return sum_G, sum_Gx, sum_Gy
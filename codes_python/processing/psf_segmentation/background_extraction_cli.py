@@ -5,10 +5,10 @@ import random
 import numpy as np
 import copy
 import cv2
+import hashlib
 import os
+import time
 from astropy.io import fits
-from astropy.utils.data import download_file
-import matplotlib.pyplot as plt
 from scipy.signal import convolve2d
 import scipy.stats as st
 from scipy.signal import medfilt2d
@@ -52,14 +52,9 @@ def iterative_sigma_clipping(original_image, preprocessed_image, curr_iter, last
         standard_deviation = np.std(last_iter_background)
         mean_deviation = np.mean(last_iter_background)
 
-        new_iter_background = np.zeros(last_iter_background.shape)
-        for num_col in range(last_iter_background.shape[0]):
-            for num_row in range(last_iter_background.shape[1]):
-                term = np.absolute(last_iter_background[num_col,num_row] - mean_deviation)
-                if term < 3*standard_deviation:
-                    new_iter_background[num_col,num_row] = last_iter_background[num_col,num_row]
-                else:
-                    new_iter_background[num_col,num_row] = mean_deviation
+        # outliers are replaced by the mean, whole image at once
+        term = np.absolute(last_iter_background - mean_deviation)
+        new_iter_background = np.where(term < 3*standard_deviation, last_iter_background, mean_deviation)
         return new_iter_background
 
 
@@ -82,19 +77,74 @@ def image_preprocess(image):
     image = cv2.resize(image, dsize=small_shape, interpolation=cv2.INTER_CUBIC )
     image = cv2.resize(image, dsize=initial_shape, interpolation=cv2.INTER_CUBIC)
 
-    image = medfilt2d(image.astype(np.uint8), 15)
+    # medfilt2d(image, 15) with its zero padding, medianBlur is much faster on uint8
+    image = cv2.copyMakeBorder(image.astype(np.uint8), 7, 7, 7, 7, cv2.BORDER_CONSTANT, value=0)
+    image = cv2.medianBlur(image, 15)[7:-7, 7:-7]
     image = convolve(image, 15)
     # image = image + random.randint(5,500)
     return image
 
+def mesh_background(image, box=64, iterations=5):
+    # block-median mesh: sigma-clipped medians of BOX x BOX blocks, median filtered
+    # and interpolated back to the image size
+    nrow, ncol = image.shape
+    ny = -(-nrow // box)
+    nx = -(-ncol // box)
+
+    padded = np.full((ny*box, nx*box), np.nan)
+    padded[:nrow, :ncol] = image
+    blocks = padded.reshape(ny, box, nx, box).transpose(0, 2, 1, 3).reshape(ny, nx, box*box)
+
+    for _ in range(iterations):
+        median = np.nanmedian(blocks, axis=2)[:, :, None]
+        std = np.nanstd(blocks, axis=2)[:, :, None]
+        blocks = np.where(np.absolute(blocks - median) <= 3*std, blocks, np.nan)
+
+    mesh = np.nanmedian(blocks, axis=2)
+    mesh[np.isnan(mesh)] = np.nanmedian(mesh)
+    if min(ny, nx) >= 3:
+        mesh = medfilt2d(mesh, 3)
+
+    background = cv2.resize(mesh, dsize=(nx*box, ny*box), interpolation=cv2.INTER_CUBIC)
+    return background[:nrow, :ncol]
+
+def cached_background(image, iterations=5, method='sigma', box=64, cache_dir=None):
+    # sigma_clipper with the result saved in CACHE_DIR as .npy, keyed by a hash of the image and the parameters
+    if cache_dir is None:
+        return sigma_clipper(image, iterations=iterations, method=method, box=box)
+
+    data = np.ascontiguousarray(image)
+    digest = hashlib.sha1(memoryview(data))  # hashed in place, the same key as of the bytes
+    digest.update(f'{data.shape}{data.dtype.str}'.encode())
+    key = f'{digest.hexdigest()}_{method}_{iterations}' + (f'_{box}' if method == 'mesh' else '')
+    path = os.path.join(cache_dir, f'{key}.npy')
+
+    if os.path.exists(path):
+        return np.load(path)
+
+    background = sigma_clipper(image, iterations=iterations, method=method, box=box)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, background)
+    os.replace(tmp_path, path)  # runs sharing the cache never read a partial file
+
+    return background
+
 def show_hist(image):
+    import matplotlib.pyplot as plt
+
     flattened = image.flatten()
     x1,x2,y1,y2 = plt.axis()
     plt.hist(flattened, np.unique(flattened).shape[0])
     plt.axis((np.min(flattened)-10, np.max(flattened)+10, 0, 10000))
     plt.show()
 
-def sigma_clipper( image, num_tiles_width = 1, num_tiles_height = 1 , iterations = 5):
+def sigma_clipper( image, num_tiles_width = 1, num_tiles_height = 1 , iterations = 5, method = 'sigma', box = 64):
+    if method == 'mesh':
+        return mesh_background(image, box, iterations)
+
     if num_tiles_width != 1 or num_tiles_height != 1:
         tile_rows = np.array_split(image, num_tiles_height)
         final = np.zeros(image.shape)
@@ -137,6 +187,9 @@ if __name__ == '__main__':
     parser.add_argument("-i", help="number of iterations(default = 5)", type=int)
     parser.add_argument("-a", help="file is in absolute path format", action="store_true")
     parser.add_argument("-o", help="name of background file(default = file + _bg)")
+    parser.add_argument("-m", help="background method, sigma or mesh(default = sigma)", default='sigma')
+    parser.add_argument("-s", help="block size of the mesh method(default = 64)", type=int, default=64)
+    parser.add_argument("-b", help="benchmark the methods against each other", action="store_true")
     args = parser.parse_args()
     if '/' not in args.file:
         directory = os.getcwd()
@@ -152,11 +205,20 @@ if __name__ == '__main__':
     image = fits.getdata(input_file)
 
     file_name, extension = os.path.basename(input_file).split('.')
-    if args.i:
-        extracted_background = sigma_clipper(image, iterations=args.i)
+    if args.b:
+        iterations = args.i if args.i else 5
+        backgrounds = {}
+        for method in ('sigma', 'mesh'):
+            start = time.time()
+            backgrounds[method] = sigma_clipper(image, iterations=iterations, method=method, box=args.s)
+            print("{:6s} {:.3f} s, median {:.3f}".format(method, time.time() - start, np.median(backgrounds[method])))
+        difference = backgrounds['mesh'] - backgrounds['sigma']
+        print("mesh - sigma: mean {:.3f}, rms {:.3f}".format(np.mean(difference), np.sqrt(np.mean(difference**2))))
+    elif args.i:
+        extracted_background = sigma_clipper(image, iterations=args.i, method=args.m, box=args.s)
         my_comment = "Extracted background with {} iterations".format(args.i)
         print(my_comment)
         print(extracted_background)
     else:
-        extracted_background = sigma_clipper(image)
+        extracted_background = sigma_clipper(image, method=args.m, box=args.s)
         my_comment = "Extracted background with {} iterations".format(5)
@@ -0,0 +1,52 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+def distance_clusters(Xs, Ys, thresh):
+    # single linkage clusters of pixels with the distance criterion (as scipy fclusterdata),
+    # pixels not farther than THRESH are in the same cluster, labels are 1..k
+    # neighbours are looked up in the sorted pixel keys one offset at a time,
+    # time is O(n log n * number of offsets) and memory O(n) instead of the O(n^2) distance matrix
+    Xs = np.asarray(Xs, dtype=np.int64)
+    Ys = np.asarray(Ys, dtype=np.int64)
+    n = len(Xs)
+
+    if n == 0:
+        return np.zeros(0, dtype=int)
+
+    r = int(np.floor(thresh))
+
+    # keys of a grid padded by R columns, shifted pixels do not wrap to the next row
+    X = Xs - Xs.min() + r
+    Y = Ys - Ys.min()
+    width = X.max() + r + 1
+    keys = Y * width + X
+
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+
+    labels = np.arange(n)
+
+    # half of the neighbourhood, every pair is visited once
+    for dy in range(0, r + 1):
+        for dx in range(-r, r + 1):
+            if dy == 0 and dx <= 0:
+                continue
+            if np.sqrt(dx**2 + dy**2) > thresh:
+                continue
+
+            targets = keys + dy * width + dx
+            pos = np.minimum(np.searchsorted(sorted_keys, targets), n - 1)
+            found = sorted_keys[pos] == targets
+
+            if not np.any(found):
+                continue
+
+            i = labels[found]
+            j = labels[order[pos[found]]]
+            graph = coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(n, n))
+            _, components = connected_components(graph, directed=False)
+            labels = components[labels]
+
+    return np.unique(labels, return_inverse=True)[1].reshape(-1) + 1
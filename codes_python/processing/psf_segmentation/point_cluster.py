@@ -3,9 +3,8 @@ import math
 from scipy.optimize import curve_fit
 from scipy.special import erf, seterr
 from scipy.stats import kurtosis, skew
-from astropy.modeling import models, fitting
-import scipy.integrate as integrate
 import warnings
+from functools import lru_cache
 
 from utils.run_functions import psnr, brightness_error
 from utils.run_functions import rms
@@ -14,11 +13,23 @@ from utils.structures import DatabaseItem
 seterr(all='ignore') # suppress fitting errors
 warnings.simplefilter("ignore") # suppress fitting warnings
 
+@lru_cache(maxsize=64)
+def square_grid(width, height):
+    # pixel coordinates of a square (meshgrid), shared by all fits of the same square size
+    x = np.linspace(0, width-1, width)
+    y = np.linspace(0, height-1, height)
+    x, y = np.meshgrid(x, y)
+    x.flags.writeable = False
+    y.flags.writeable = False
+    return x, y
+
 class PointCluster(object):
     ''' Object representing single cluster of pixels, fits functions as well as produces output for object '''
 
-    def __init__(self, points, image):
+    def __init__(self, points, image, frame_shape=None):
+        # IMAGE may be a part of the frame of FRAME_SHAPE (whole image by default)
         self.points = points
+        self.frame_shape = frame_shape if frame_shape is not None else image.shape
         self.correct_fit = False
         self.peak_point = None
         self.header_data = None
@@ -36,6 +47,7 @@ class PointCluster(object):
         self.total_err = None
         self.is_line = False
         self.cumulated_flux = None
+        self.budget_reached = False
 
     def __repr__(self):
         '''x y Flux  FWHM PeakSNR RMS Skew Kurtosis'''
@@ -48,7 +60,7 @@ class PointCluster(object):
 
     def output_database_item(self):
 
-        n_b = self.image.shape[0] * self.image.shape[1]
+        n_b = self.frame_shape[0] * self.frame_shape[1]
         bri_error = brightness_error(self.cumulated_flux, self.noise_median, len(self.points), n_b)
 
         return DatabaseItem(abs(self.x0), abs(self.y0), self.psnr, self.rms, \
@@ -73,23 +85,65 @@ class PointCluster(object):
         g = offset + amplitude*np.exp( - (a*((x-xo)**2) + 2*b*(x-xo)*(y-yo) + c*((y-yo)**2)))
         return g.ravel()
 
+    def gaussian_2d_jacobian(self, data_tuple, amplitude, xo, yo, sigma_x, sigma_y, theta, offset):
+        # analytic derivatives of gaussian_2d by its parameters, one column per parameter
+        (x, y) = data_tuple
+        dx = x.ravel() - float(xo)
+        dy = y.ravel() - float(yo)
+        cos2, sin2, sin2t, cos2t = np.cos(theta)**2, np.sin(theta)**2, np.sin(2*theta), np.cos(2*theta)
+        a = cos2/(2*sigma_x**2) + sin2/(2*sigma_y**2)
+        b = -sin2t/(4*sigma_x**2) + sin2t/(4*sigma_y**2)
+        c = sin2/(2*sigma_x**2) + cos2/(2*sigma_y**2)
+        e = np.exp( - (a*dx**2 + 2*b*dx*dy + c*dy**2))
+        ae = amplitude*e
+
+        def d_quadratic(da, db, dc):
+            return -ae*(da*dx**2 + 2*db*dx*dy + dc*dy**2)
+
+        jac = np.empty((len(dx), 7))
+        jac[:, 0] = e
+        jac[:, 1] = ae*(2*a*dx + 2*b*dy)
+        jac[:, 2] = ae*(2*b*dx + 2*c*dy)
+        jac[:, 3] = d_quadratic(-cos2/sigma_x**3, sin2t/(2*sigma_x**3), -sin2/sigma_x**3)
+        jac[:, 4] = d_quadratic(-sin2/sigma_y**3, -sin2t/(2*sigma_y**3), -cos2/sigma_y**3)
+        jac[:, 5] = d_quadratic(-sin2t/(2*sigma_x**2) + sin2t/(2*sigma_y**2),
+                                -cos2t/(2*sigma_x**2) + cos2t/(2*sigma_y**2),
+                                sin2t/(2*sigma_x**2) - sin2t/(2*sigma_y**2))
+        jac[:, 6] = 1
+        return jac
+
+    def fit_gaussian_2d(self, x, y, p0, budget):
+        # least squares gaussian fit with analytic jacobian, at most BUDGET function evaluations
+        return self.fit_with_budget(self.gaussian_2d, (x, y), p0, jac=self.gaussian_2d_jacobian, maxfev=budget)
+
+    def fit_with_budget(self, function, xdata, p0, **kwargs):
+        # curve_fit of the square, fits stopped by the evaluation budget are marked
+        try:
+            return curve_fit(function, xdata, self.squared_data.flatten(), p0=p0, **kwargs)
+        except RuntimeError as e:
+            if 'maxfev' in str(e) or 'function evaluations' in str(e):
+                self.budget_reached = True
+            raise
+
     def veres(self, data_tuple, x0, y0, width, length, rotation, total_flux):
-        # (x, y) = data_tuple
+        # streak of TOTAL_FLUX: gaussian profile of WIDTH integrated along a segment of LENGTH
+        # rotated by ROTATION (degrees) around (x0, y0), plus the background, on the pixel grid of the square
+        # integral of the gaussian along the segment in closed form with erf
         x0 = float(x0)
         y0 = float(y0)
 
-        res_arr = np.zeros_like(data_tuple[0])
+        y_init, x_init = np.indices(data_tuple[0].shape)
+        cos_r, sin_r = math.cos(math.radians(rotation)), math.sin(math.radians(rotation))
+        x = (x_init-x0) * cos_r - (y_init-y0) * sin_r
+        y = (x_init-x0) * sin_r + (y_init-y0) * cos_r
 
-        for y_init in range(data_tuple[0].shape[0]):
-            for x_init in range(data_tuple[0].shape[1]):
-                x = (x_init-x0) * math.cos(math.radians(rotation)) - (y_init-y0)*math.sin(math.radians(rotation))
-                y = (x_init-x0) * math.sin(math.radians(rotation)) + (y_init-y0)*math.cos(math.radians(rotation))
-                first_term = total_flux / length
-                second_term = (1/(math.sqrt(2*math.pi*width**2)))
-                third_term = integrate.quad(lambda l: np.exp(-1/(2*width**2)*((x-l)**2+y**2)) ,-length//2, length//2)
+        first_term = total_flux / length
+        second_term = (1/(math.sqrt(2*math.pi*width**2)))
+        scale = math.sqrt(2) * width
+        third_term = np.exp(-y**2/(2*width**2)) * math.sqrt(math.pi/2) * width * \
+            (erf((x + length/2) / scale) - erf((x - length/2) / scale))
 
-                res = self.background_data[y_init][x_init] + first_term * second_term * third_term[0]
-                res_arr[y_init][x_init] = res
+        res_arr = self.background_data + first_term * second_term * third_term
         # show_3d_data(res_arr, secondary_data=[self.squared_data])
         return res_arr.ravel()
 
@@ -109,36 +163,32 @@ class PointCluster(object):
         return height, x, y, width_x, width_y
 
     def fill_to_square(self, square_width, square_height, center=None):
-        max_value = 0
         self.is_line = square_height != square_width
-        self.low_y, self.low_x = self.image.shape
-        for point in self.points:
-            if self.image[point[1], point[0]] >= max_value:
-                self.peak_point = point
-                max_value = self.image[point[1],point[0]]
-            if point[1] <= self.low_y:
-                self.low_y = point[1]
-            if point[0] <= self.low_x:
-                self.low_x = point[0]
+
+        # brightest point (the last one of equal values)
+        values = self.image[self.points[:, 1], self.points[:, 0]]
+        if len(values) > 0 and values.max() >= 0:
+            self.peak_point = self.points[len(values) - 1 - np.argmax(values[::-1])]
+
         if center is not None:
             self.peak_point = (self.peak_point[0] + (center[0] - square_width//2), self.peak_point[1] + (center[1] - square_height//2))
-        square = np.zeros((square_height, square_width))
-        mid_x, mid_y = square_width // 2, square_height // 2
-        for y in range(square_height):
-            for x in range(square_width):
-                relative_x = self.peak_point[0] - mid_x + x
-                relative_y = self.peak_point[1] - mid_y + y
-                square[y,x] = self.image[relative_y,relative_x]
-        self.background_data = np.zeros((square_height, square_width))
+
         self.low_x = self.peak_point[0] - (square_width//2)
         self.low_y = self.peak_point[1] - (square_height//2)
-        for y, row in enumerate(self.background_data):
-            for x, pixel in enumerate(row):
-                self.background_data[y][x] = self.background_data_raw[y+self.low_y][x+self.low_x]
-        return square
 
+        if self.low_x < 0 or self.low_y < 0 or \
+            self.low_x + square_width > self.image.shape[1] or \
+            self.low_y + square_height > self.image.shape[0]:
+            raise IndexError("Square out of the image")
+
+        rows = slice(self.low_y, self.low_y + square_height)
+        cols = slice(self.low_x, self.low_x + square_width)
+
+        self.background_data = np.array(self.background_data_raw[rows, cols], dtype=float)
+        return np.array(self.image[rows, cols], dtype=float)
 
-    def fit_curve(self, function='gauss', square_size=(11,11)):
+
+    def fit_curve(self, function='gauss', square_size=(11,11), budget=10000):
         try:
             if not isinstance(square_size[0], int):
                 square_size = (int(square_size[0]), int(square_size[1]))
@@ -150,16 +200,14 @@ class PointCluster(object):
         self.noise_median = np.median(self.background_data)
 
         if function == 'gauss':
-            x = np.linspace(0, square_size[0]-1, square_size[0])
-            y = np.linspace(0, square_size[1]-1, square_size[1])
-            x, y = np.meshgrid(x, y)
+            x, y = square_grid(*square_size)
 
             if self.squared_data.sum() == 0:
                 self.correct_fit = False
                 return
             moments = self.moments(self.squared_data)
             pred = [*moments, 10, 0]
-            popt, pcov = curve_fit(self.gaussian_2d, (x, y), self.squared_data.flatten(), maxfev=100000, xtol=1e-10, ftol=1e-10, p0=pred)
+            popt, pcov = self.fit_gaussian_2d(x, y, pred, budget)
             try:
                 if popt is not None and popt[3] is not None and popt[3] != 0:
                     self.correct_fit = True
@@ -183,8 +231,8 @@ class PointCluster(object):
                 self.y0 >= self.image.shape[0] or \
                 math.isnan(self.fwhm_x) or \
                 math.isnan(self.fwhm_y) or \
-                self.fwhm_x >= self.image.shape[1] or \
-                self.fwhm_y >= self.image.shape[0]:
+                self.fwhm_x >= self.frame_shape[1] or \
+                self.fwhm_y >= self.frame_shape[0]:
                 self.correct_fit = False
                 return
             self.fwhm = "{}|{}".format(abs(round(self.fwhm_x, 2)),abs(round(self.fwhm_y, 2)))
@@ -197,14 +245,12 @@ class PointCluster(object):
             self.length = 50 # from self.header_data
             self.width = 0.5 # from self.header_data
             self.rotation = 45 # rotation from self.header_data
-            x = np.linspace(0, square_size[0]-1, square_size[0])
-            y = np.linspace(0, square_size[1]-1, square_size[1])
-            x, y = np.meshgrid(x, y)
+            x, y = square_grid(*square_size)
 
             # gaussian
             moments = self.moments(self.squared_data)
             pred = [*moments, 10, 0]
-            popt, pcov = curve_fit(self.gaussian_2d, (x, y), self.squared_data.flatten(), maxfev=500000000, xtol=1e-15, ftol=1e-15, p0=pred)
+            popt, pcov = self.fit_gaussian_2d(x, y, pred, budget)
             predicted_gauss = self.gaussian_2d((x, y), *popt).reshape(*self.squared_data.shape)
 
             self.x0 = popt[1]
@@ -220,35 +266,52 @@ class PointCluster(object):
             except IndexError:
                 raise IndexError("Border object, ignore")
 
-            total_flux = self.squared_data - (np.median(self.background_data)+100)
-            total_flux = total_flux[total_flux>0].sum() // 3
+            # flux above the background bounds the total flux of the streak
+            total_flux = self.squared_data - self.background_data
+            total_flux = total_flux[total_flux>0].sum()
+            if total_flux <= 0:
+                self.correct_fit = False
+                return
             prediction = [square_size[0]//2, square_size[1]//2, 1.5, 55, 45, total_flux]
-            # popt, pcov = curve_fit(self.veres, np.array((x, y), dtype=int), self.squared_data.flatten(), maxfev=500000000 )
-            veres_bounds = ([0,0,0,0,0,0],[self.squared_data.shape[1], self.squared_data.shape[0], 10, 70, 90, total_flux])
-            popt, pcov = curve_fit(self.veres, np.array((x, y), dtype=int), self.squared_data.flatten(), maxfev=500000000, p0=prediction, bounds=veres_bounds )
-            # print(pcov)
+            veres_bounds = ([0,0,0,0,0,0],[self.squared_data.shape[1], self.squared_data.shape[0], 10, 70, 90, 2*total_flux])
+            popt, pcov = self.fit_with_budget(self.veres, (x, y), prediction, max_nfev=budget, bounds=veres_bounds)
+            if popt is None or popt[2] == 0 or popt[3] == 0:
+                self.correct_fit = False
+                return
+            self.correct_fit = True
 
-            # self.predicted = self.veres((x, y), *prediction).reshape(*self.squared_data.shape)
-            self.predicted = self.veres((x, y), *popt).reshape(*self.squared_data.shape)
-            # self.fwhm = "{}|{}".format(abs(round(popt[2], 2)),abs(round(popt[3], 2)))
-            self.fwhm = "unknown"
+            perr = np.sqrt(np.diag(pcov))
+            self.x0_err = perr[0] if perr[0] != np.inf else 0.0
+            self.y0_err = perr[1] if perr[1] != np.inf else 0.0
+            self.total_err = np.sqrt(self.x0_err**2 + self.y0_err**2) if self.y0_err else 0.0
 
+            # fwhm along the streak is its length, across the streak the fwhm of its profile
+            self.fwhm_x = abs(popt[3])
+            self.fwhm_y = 2*math.sqrt(2*math.log(2)) * abs(popt[2])
+            self.x0 = round(self.low_x + popt[0], 2)
+            self.y0 = round(self.low_y + popt[1], 2)
+            if self.x0 >= self.image.shape[1] or \
+                self.y0 >= self.image.shape[0] or \
+                math.isnan(self.x0) or \
+                math.isnan(self.y0) or \
+                self.fwhm_x >= self.frame_shape[1] or \
+                self.fwhm_y >= self.frame_shape[0]:
+                self.correct_fit = False
+                return
+            self.fwhm = "{}|{}".format(round(self.fwhm_x, 2), round(self.fwhm_y, 2))
 
+            self.predicted = self.veres((x, y), *popt).reshape(*self.squared_data.shape)
             self.rms_res = rms(self.squared_data, self.predicted)
 
         self.cumulated_flux = round(self.squared_data.sum())
-        self.skew_mid_x = round(skew(self.squared_data, 1)[square_size[1]//2], 2)
-        self.skew_mid_y = round(skew(self.squared_data, 0)[square_size[0]//2], 2)
-        self.kurtosis_mid_x = round(kurtosis(self.squared_data, 1, fisher=True)[square_size[1]//2], 2)
-        self.kurtosis_mid_y = round(kurtosis(self.squared_data, 0, fisher=True)[square_size[0]//2], 2)
+        # statistics of the middle row and the middle column
+        mid_row = self.squared_data[square_size[1]//2, :]
+        mid_col = self.squared_data[:, square_size[0]//2]
+        self.skew_mid_x = round(skew(mid_row), 2)
+        self.skew_mid_y = round(skew(mid_col), 2)
+        self.kurtosis_mid_x = round(kurtosis(mid_row, fisher=True), 2)
+        self.kurtosis_mid_y = round(kurtosis(mid_col, fisher=True), 2)
         self.skew = str(self.skew_mid_x) + "|" + str(self.skew_mid_y)
         self.kurtosis = str(self.kurtosis_mid_x) + "|" + str(self.kurtosis_mid_y)
         self.rms = round(self.rms_res, 3)
         self.psnr = psnr(self.squared_data, self.noise_median, 5)
-
-if __name__ == '__main__':
-    square_size = (50,50)
-    x = np.linspace(0, square_size[0]-1, square_size[0])
-    y = np.linspace(0, square_size[1]-1, square_size[1])
-    x, y = np.meshgrid(x, y)
-    veresed = veres((x,y), 25, 25, 40, 5, 200, 0)
@@ -1,56 +1,47 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy import ndimage
-from scipy.optimize import curve_fit
-
-from processing.psf_segmentation.point_cluster import PointCluster
 
 np.seterr(all='ignore')
 
 def sobel_extract_clusters(image, threshold=20):
+    joined_points = join_neigbor_points_mask(sobel_mask(image, threshold))
+
+    return joined_points
+
+def sobel_magnitude(image):
     image_int32 = image.astype('int32')
     dx = ndimage.sobel(image_int32, 0)
     dy = ndimage.sobel(image_int32, 1)
-    mag = np.hypot(dx, dy)
-    mag *= 255.0 / np.max(mag)
+    return np.hypot(dx, dy)
+
+def sobel_mask(image, threshold=20, scale=None):
+    # SCALE normalises the magnitude (255 / maximum of the IMAGE by default), parts of a frame use the frame scale
+    mag = sobel_magnitude(image)
+    mag *= scale if scale is not None else 255.0 / np.max(mag)
     original_mask = mag
     mask = original_mask >= threshold
 
-    points = list()
+    return mask
 
-    joined_points = join_neigbor_points_mask(mask)
+def label_mask(mask):
+    # 4-connected clusters of the mask labelled 1..count in order of their first pixel (row by row),
+    # returns X, Y, labels of the mask pixels grouped by label
+    labels, count = ndimage.label(mask)
 
-    return joined_points
+    Y, X = np.nonzero(labels)
+    labels = labels[Y, X]
+    order = np.argsort(labels, kind='stable')
+
+    return X[order], Y[order], labels[order], count
 
 def join_neigbor_points_mask(mask):
-    joined_points = list()
-    for y, row in enumerate(mask):
-        for x, value in enumerate(row):
-            if value == 1:
-                mask[y][x] = 0
-                cluster = list()
-                cluster.append([x,y])
-                stack = [[x,y]]
-                while len(stack) > 0:
-                    x_p,y_p = stack.pop()
-                    if x_p-1 >= 0 and mask[y_p][x_p-1] == 1:
-                        mask[y_p][x_p-1] = 0
-                        stack.append([x_p-1,y_p])
-                        cluster.append([x_p-1,y_p])
-                    if x_p+1 < mask.shape[1] and mask[y_p][x_p+1] == 1:
-                        mask[y_p][x_p+1] = 0
-                        stack.append([x_p+1,y_p])
-                        cluster.append([x_p+1,y_p])
-                    if y_p-1 >= 0 and mask[y_p-1][x_p] == 1:
-                        mask[y_p-1][x_p] = 0
-                        stack.append([x_p,y_p-1])
-                        cluster.append([x_p,y_p-1])
-                    if y_p+1 < mask.shape[0] and mask[y_p+1][x_p] == 1:
-                        mask[y_p+1][x_p] = 0
-                        stack.append([x_p,y_p+1])
-                        cluster.append([x_p,y_p+1])
-                joined_points.append(cluster)
-    return joined_points
+    # list of (X, Y) index arrays of the clusters
+    X, Y, labels, count = label_mask(mask)
+    if count == 0:
+        return []
+    splits = np.cumsum(np.bincount(labels, minlength=count + 1)[1:-1])
+
+    return list(zip(np.split(X, splits), np.split(Y, splits)))
 
 def gaussian(x, amp, cen, wid):
     return amp * np.exp(-(x-cen)**2 / wid)
@@ -58,6 +49,8 @@ def gaussian(x, amp, cen, wid):
 def histogram_threshold(image, show=False, threshold_sigma=2, sigma_only=False):
     hist, bins = np.histogram(image.flatten(), bins=len(np.unique(image)))
 
+    from scipy.optimize import curve_fit
+
     init_vals = [1000., 0., 1000.]
     np.seterr(all='ignore')
     best_vals, covar = curve_fit(gaussian, [x for x in range(len(hist))], hist, p0=init_vals, maxfev=5000)
@@ -71,6 +64,8 @@ def histogram_threshold(image, show=False, threshold_sigma=2, sigma_only=False):
         return sigma
     threshold = int(center + sigma*threshold_sigma)
     if show:
+        import matplotlib.pyplot as plt
+
         fig = plt.figure()
         ax = fig.add_subplot(111)
         # smoothed = smooth(hist,15) ax.bar([x for x in range(len(hist))], hist)
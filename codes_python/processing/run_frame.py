@@ -0,0 +1,68 @@
+from time import time
+
+from utils import run_call
+from processing import run_serial, run_parallel
+
+
+def run_frame(args, frame, t_init, executor=None):
+    # centroiding of one frame with the outputs of main.py, EXECUTOR is a pool kept over frames (batch)
+    run_call.save_call(args)  # writes call arguments to file
+
+    t_load = time()
+    if not args.sections:  # with sections the workers read their parts of the image
+        frame.data()
+    print('Image loaded')
+
+    t_cmp = time()
+    if args.parallel <= 1 and args.workers is None and args.tile_size is None:  # run serial
+        log_file = ''
+        if args.verbose == 1:
+            log_file = f'{args.output}.log'
+
+        print('start serial process')
+
+        process = run_serial.Serial(args, frame.data(), log_file='log1.log')
+        result = process.execute(index=(0, frame.shape[0] - 1, 0, frame.shape[1] - 1))
+    else:
+        process = run_parallel.Parallel(args, frame, executor=executor)
+        result = process.execute()
+
+    result.print_stats()
+    if result.database.size() == 0:
+        print('\nNo stars found!')
+    else:
+        t_wrt = time()
+        formats = args.catalog.split(',')
+        result.database.write_catalog(f'{args.output}_s', formats)
+        result.discarded.write_catalog(f'{args.output}_discarded', formats)
+
+        print(f'\nIdentified stars: {len(result.database.data)}')
+        print(f'Discarded stars: {len(result.discarded.data)}')
+
+        # the catalog is complete before the pdf is drawn (report sync), by another process (background) or never (none)
+        if args.report != 'none' or args.model:
+            from utils import report  # matplotlib and scipy.stats are loaded only for the report
+
+            report_result = report.match_report(result.database, args)
+
+            report_result.print()
+
+            if args.model:
+                report_result.write_catalog(args.output, result.database, formats)
+
+            if args.report == 'sync':
+                report.write_pdf(result.database, frame.data(), args, report_result)
+            elif args.report == 'background':
+                report.write_pdf_background(result.database, frame.data(), args, report_result, executor=executor)
+
+        t_end = time()
+
+        print("\n------- Time ---------\n")
+        print(f'Init time      : {t_load-t_init:.4f} sec')
+        print(f'Loading time   : {t_cmp-t_load:.4f} sec')
+        print(f'Computing time : {t_wrt-t_cmp:.4f} sec')
+        print(f'Write time     : {t_end - t_wrt:.4f} sec')
+        if result.first_centroid is not None:
+            print(f'First centroid : {result.first_centroid - t_init:.4f} sec')
+
+    return result
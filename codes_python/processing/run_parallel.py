@@ -1,55 +1,176 @@
 import concurrent.futures
+import os
+from multiprocessing import shared_memory
+import numpy as np
 from processing import run_serial
 from  copy import deepcopy
+from utils.frame import Frame
 from utils.run_functions import combine_results
 
 
 def execute_serial(arg):
-    index, args, image = arg
-    process = run_serial.Serial(args, image)
-    return process.execute(index)
+    index, owned, args, image_info, background_info, window, frame_shape, sobel_scale = arg
+
+    # attach to the image and the background in shared memory (no copy),
+    # or read only the WINDOW of the frame from the file
+    shms = []
+    try:
+        origin = (0, 0)
+        if image_info[0] == 'file':
+            frame = Frame(image_info[1])
+            try:
+                image, origin = frame.section(*window)
+            finally:
+                frame.close()
+        else:
+            image = attach(image_info, shms)
+
+        background = None
+        if background_info is not None:
+            background = attach(background_info, shms)
+            background = background[origin[1]:origin[1] + image.shape[0], origin[0]:origin[0] + image.shape[1]]
+
+        process = run_serial.Serial(args, image, background=background, origin=origin,
+                                    frame_shape=frame_shape, sobel_scale=sobel_scale)
+        result = process.execute(index, owned)
+    finally:
+        process = image = background = None  # views of the shared buffers must be released before closing them
+        for shm in shms:
+            try:
+                shm.close()
+            except BufferError:  # views kept by the traceback of an error, the buffer is released with them
+                pass
+
+    return result
+
+
+def attach(info, shms):
+    name, shape, dtype = info
+    shm = shared_memory.SharedMemory(name=name)
+    shms.append(shm)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def share_image(image):
+    # copy the image (or the background map) once to shared memory, workers attach to it by name
+    shm = shared_memory.SharedMemory(create=True, size=max(image.nbytes, 1))
+    shared = np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)
+    shared[:] = image
+    return shm, (shm.name, image.shape, image.dtype)
+
+
+def pool_size(args):
+    # tiles are independent of the pool, idle workers pick up the remaining tiles
+    workers = args.workers if args.workers is not None else max(args.parallel, 1)**2
+    return max(1, min(workers, os.cpu_count() or 1))
 
 
 class Parallel:
 
-    def __init__(self, args, image):
+    def __init__(self, args, frame, executor=None):
         
         self.args = args
-        self.image = image
+        self.frame = frame
+        self.shape = frame.shape
+        self.executor = executor  # pool kept by the caller (batch), a new pool for this frame if not given
 
-        self.parallel = self.args.parallel
-        self.no_cores = self.parallel**2
+        self.parallel = max(self.args.parallel, 1)
+        self.no_cores = pool_size(self.args)
 
-    def execute(self):
+    def halo(self):
+        # tiles are processed with a halo, objects on the seams are found by both neighbours
+        # and kept by the tile owning their centre
+        if self.args.halo is not None:
+            return int(np.ceil(self.args.halo))
 
-        lenX = self.image.shape[0] // self.parallel
-        lenY = self.image.shape[1] // self.parallel
+        return int(np.ceil(2 * max(self.args.width, self.args.height) + self.args.noise_dim))
 
-        args = []
+    def borders(self, size):
+        # tile borders along one axis of SIZE pixels, PxP grid unless tile size is set
+        if self.args.tile_size is not None:
+            starts = list(range(0, size - 1, max(int(self.args.tile_size), 1)))
+        else:
+            length = size // self.parallel
+            starts = [i*length for i in range(self.parallel)]
 
-        for i in range(self.parallel):
-            
-            x_start = i*lenX 
+        return starts + [size - 1]
 
-            if i < self.parallel - 1:
-                x_end = (i+1)*lenX
-            else:
-                x_end = self.image.shape[0]-1
-            
-            for j in range(self.parallel):
+    def tiles(self):
+        # (index, owned) of the tiles, see Serial.execute
+        halo = self.halo()
+        X = self.borders(self.shape[0])
+        Y = self.borders(self.shape[1])
+
+        tiles = []
+        for i in range(len(X) - 1):
+            x_start, x_end = X[i], X[i + 1]
+
+            for j in range(len(Y) - 1):
+                y_start, y_end = Y[j], Y[j + 1]
+
+                index = (max(x_start - halo, 0), min(x_end + halo, self.shape[0] - 1),
+                         max(y_start - halo, 0), min(y_end + halo, self.shape[1] - 1))
 
-                y_start = j*lenY
+                # owned parts split the whole plane, the outer tiles own everything beyond the frame
+                owned = (x_start if i > 0 else -np.inf, x_end if i < len(X) - 2 else np.inf,
+                         y_start if j > 0 else -np.inf, y_end if j < len(Y) - 2 else np.inf)
 
-                if j < self.parallel - 1:
-                    y_end = (j+1)*lenY
-                else:
-                    y_end = self.image.shape[1]-1
+                tiles.append((index, owned))
 
-                args.append(((x_start,x_end,y_start,y_end), deepcopy(self.args), self.image.copy()))
+        return tiles
 
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            results = [ result for result in executor.map(execute_serial, args)]
+    def execute(self):
+
+        tiles = self.tiles()
+        results = [None] * len(tiles)
+        halo = self.halo()
+
+        shms = []
+        try:
+            # with sections every worker reads its tile and a halo around it from the file,
+            # otherwise the whole image is shared
+            sobel_scale = None
+            if self.args.sections:
+                image_info = ('file', self.frame.filename)
 
-        result = combine_results(results)
+                # the sobel gradient is normalised over the whole frame
+                if self.args.method == "sobel":
+                    from processing.psf_segmentation.sobel import sobel_magnitude
+
+                    image = self.frame.data()
+                    sobel_scale = 255 / np.max(sobel_magnitude(image[:self.shape[0] - 1, :self.shape[1] - 1]))
+            else:
+                shm, image_info = share_image(self.frame.data())
+                shms.append(shm)
+
+            # the psf background is computed once for the frame, not in every tile
+            background_info = None
+            if self.args.psf:
+                shm, background_info = share_image(run_serial.psf_background(self.frame.data(), self.args))
+                shms.append(shm)
+
+            executor = self.executor
+            if executor is None:
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(self.no_cores, len(tiles)))
+
+            try:
+                futures = {}
+                for k, (index, owned) in enumerate(tiles):
+                    window = (index[0] - halo, index[1] + halo, index[2] - halo, index[3] + halo)
+                    arg = (index, owned, deepcopy(self.args), image_info, background_info, window, self.shape, sobel_scale)
+                    futures[executor.submit(execute_serial, arg)] = k
+
+                for future in concurrent.futures.as_completed(futures):
+                    results[futures[future]] = future.result()
+            finally:
+                if self.executor is None:
+                    executor.shutdown()
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+        # tiles are merged in grid order, the output does not depend on the scheduling
+        result = combine_results(results, self.args.centre_limit)
 
         return result
@@ -1,24 +1,39 @@
-import scipy.cluster.hierarchy as hcluster
-
-from processing.psf_segmentation.background_extraction_cli import sigma_clipper
-from processing.psf_segmentation.point_cluster import PointCluster
-from processing.psf_segmentation.sobel import sobel_extract_clusters
 from processing.getPixels import get_pixels
-from processing.wrapper import CentroidSimpleWrapper
+from processing.integralImage import IntegralImage
+from processing.wrapper import CentroidSimpleWrapper, CentroidBatchWrapper
 from utils.structures import *
 
 from utils.structures import Database
 
 import os
+import time
+import warnings
+
+# the psf, sobel and cluster modules (scipy, astropy, cv2) are imported by the methods using them,
+# numpy and fit warnings are suppressed for the whole run
+np.seterr(all='ignore')
+warnings.simplefilter("ignore")
+
+
+def psf_background(image, args):
+    from processing.psf_segmentation.background_extraction_cli import cached_background
+
+    return cached_background(image, iterations=args.bkg_iterations, method=args.bkg_method,
+                             box=args.bkg_box, cache_dir=args.bkg_cache)
 
 
 class Serial:
 
-    def __init__(self, args, image, log_file=""):
+    def __init__(self, args, image, log_file="", background=None, origin=(0, 0), frame_shape=None, sobel_scale=None):
+        # IMAGE may be a part of the frame of FRAME_SHAPE starting at ORIGIN = (x, y), positions in INDEX,
+        # OWNED and in the results are in frame coordinates (see execute)
         self.args: Configuration = args
         self.log_file = log_file
         self.image = image
-        self.psf_bckg = None
+        self.psf_bckg = background  # background map of the psf fits, computed on the first fit if not given
+        self.origin = origin
+        self.frame_shape = frame_shape if frame_shape is not None else image.shape
+        self.sobel_scale = sobel_scale  # normalisation of the sobel magnitude, from the image by default
 
     def log(self,msg):
 
@@ -30,11 +45,21 @@ class Serial:
 
     def clear_statistics(self):
         self.stats = Stats()
+        self.first_centroid = None  # time of the first kept object (startup benchmark)
 
-    def execute(self, index):
+    def execute(self, index, owned=None):
+        # INDEX = (x_start, x_end, y_start, y_end) is the processed part of the image,
+        # OWNED = (x_start, x_end, y_start, y_end) with exclusive ends is the part whose objects are kept
+        # (parallel tiles are processed with a halo around the owned part), everything is owned by default
         self.clear_statistics()
 
+        # positions in the image are used internally, the results are shifted to the frame at the end
+        ox, oy = self.origin
         x_start, x_end, y_start, y_end = index
+        x_start, x_end, y_start, y_end = x_start - ox, x_end - ox, y_start - oy, y_end - oy
+        if owned is not None:
+            owned = (owned[0] - ox, owned[1] - ox, owned[2] - oy, owned[3] - oy)
+        self.owned = owned
 
         self.database  = Database()
         self.discarded = Database()
@@ -42,14 +67,26 @@ class Serial:
         A = self.args.width
         B = self.args.height
 
+        self.integral = None
+        if self.use_integral_image():
+            # window of the processed part with a margin for boxes moving during the iterations
+            margin = int(np.ceil(2 * (A + B))) + 2
+            self.integral = IntegralImage(self.image, (x_start - margin, x_end + margin, y_start - margin, y_end + margin))
+
         if self.args.method == 'sweep':
 
-            Xs = np.floor(np.arange(x_start + A, x_end - A, 2*A )).astype(int)
-            Ys = np.floor(np.arange(y_start + B, y_end - B, 2*B )).astype(int)
+            if owned is None:
+                Xs = np.floor(np.arange(x_start + A, x_end - A, 2*A )).astype(int)
+                Ys = np.floor(np.arange(y_start + B, y_end - B, 2*B )).astype(int)
+            else:
+                # seeds of the whole frame grid inside the processed part, every seed is evaluated as in serial run
+                Xs = np.floor(np.arange(A, self.frame_shape[0] - 1 - A, 2*A)).astype(int) - ox
+                Ys = np.floor(np.arange(B, self.frame_shape[1] - 1 - B, 2*B)).astype(int) - oy
+                Xs = Xs[(Xs >= x_start) & (Xs <= x_end)]
+                Ys = Ys[(Ys >= y_start) & (Ys <= y_end)]
 
-            for y in Ys:
-                for x in Xs:
-                    self.perform_step(x, y)
+            X, Y = np.meshgrid(Xs, Ys)  # rows of seeds from the top
+            self.perform_steps(X.ravel(), Y.ravel())
 
         elif self.args.method == 'max':
             pixels = np.where(self.image > self.args.start_iter)
@@ -61,20 +98,25 @@ class Serial:
             Xs = Xs[good]
             Ys = Ys[good]
 
-            while len(Xs) > 0:
-                step = self.perform_step(Xs[0], Ys[0])
-                
-                Xs = Xs[1:]
-                Ys = Ys[1:]
-                
-                if step.code == 0:
-                    filt_X = np.logical_and((Xs >= (step.x - A)), (Xs <= (step.x + A)))
-                    filt_Y = np.logical_and((Ys >= (step.y - B)), (Ys <= (step.y + B)))
-                    filt = np.logical_and(filt_X, filt_Y)
-                    ok = np.logical_not(filt)
+            if self.args.max_order == 'brightness':
+                # from the brightest candidate, star peaks are tried before their halos
+                order = np.argsort(-self.image[Ys, Xs].astype(float), kind='stable')
+                Xs = Xs[order]
+                Ys = Ys[order]
+
+            # candidates in boxes of found stars are skipped
+            occupied = np.zeros(self.image.shape, dtype=bool)
 
-                    Xs = Xs[ok]
-                    Ys = Ys[ok]
+            for x, y in zip(Xs, Ys):
+                if occupied[y, x]:
+                    continue
+
+                step = self.perform_step(x, y)
+
+                if step.code == 0:
+                    x_lef = max(int(np.ceil(step.x - A)), 0)
+                    y_bot = max(int(np.ceil(step.y - B)), 0)
+                    occupied[y_bot: int(np.floor(step.y + B)) + 1, x_lef: int(np.floor(step.x + A)) + 1] = True
 
         elif self.args.method == 'cluster':
             pixels = np.where(self.image > self.args.start_iter)
@@ -86,51 +128,43 @@ class Serial:
             Xs = Xs[good]
             Ys = Ys[good]
 
-            pixels = np.zeros((len(Xs), 2))
-            pixels[:,0] = Ys
-            pixels[:,1] = Xs
             thresh = np.sqrt(A**2 + B**2)
 
-            clusters = hcluster.fclusterdata(pixels, thresh, criterion='distance')
+            from processing.psf_segmentation.distance_clusters import distance_clusters
 
+            clusters = distance_clusters(Xs, Ys, thresh)
 
-            for i in range(1, np.max(clusters)+1):
-                YX = pixels[clusters == i]
-                X = YX[:, 1]
-                Y = YX[:, 0]
-
-                Z = self.image[Y, X]
-
-                sumG = np.sum(Z)
-                sumGx = np.sum(Z * (X - 0.5))
-                sumGy = np.sum(Z * (Y - 0.5))
-
-                self.perform_step(sumGx / sumG, sumGy / sumG)
+            self.perform_cluster_steps(Xs, Ys, clusters)
 
         elif self.args.method == "sobel":
-            image = self.image[x_start: x_end, y_start: y_end]
-            sobel_threshold = self.args.sobel_threshold
+            from processing.psf_segmentation.sobel import sobel_mask, label_mask
 
-            joined_points = sobel_extract_clusters(image, threshold=sobel_threshold)
-
-            for XY in joined_points:
+            sobel_threshold = self.args.sobel_threshold
 
-                XY = np.array(XY)
-                X = XY[:, 0]
-                Y = XY[:, 1]
+            # the gradient is normalised over the whole frame, tiles use the same threshold
+            mask = sobel_mask(self.image[:self.frame_shape[0] - 1 - oy, :self.frame_shape[1] - 1 - ox],
+                              threshold=sobel_threshold, scale=self.sobel_scale)
 
-                Z = self.image[Y, X]
+            offset_x, offset_y = 0, 0
+            if owned is not None:
+                mask = mask[y_start: y_end, x_start: x_end]
+                offset_x, offset_y = x_start, y_start
 
-                sumG = np.sum(Z)
-                sumGx = np.sum(Z * (X - 0.5))
-                sumGy = np.sum(Z * (Y - 0.5))
+            X, Y, labels, count = label_mask(mask)
 
-                self.perform_step(sumGx / sumG, sumGy / sumG)
+            # clusters are in coordinates of the processed part
+            self.perform_cluster_steps(X + offset_x, Y + offset_y, labels)
 
+        if ox != 0 or oy != 0:
+            self.database.shift(ox, oy)
+            self.discarded.shift(ox, oy)
 
-        return SerialResult(database=self.database, discarded=self.discarded, stats=self.stats)
+        return SerialResult(database=self.database, discarded=self.discarded, stats=self.stats,
+                            first_centroid=self.first_centroid)
 
     def psf(self, current):
+        from processing.psf_segmentation.point_cluster import PointCluster
+
         cent_x = current.result.data[0]
         cent_y = current.result.data[1]
 
@@ -140,11 +174,10 @@ class Serial:
         X = X.reshape(-1,1)
         Y = Y.reshape(-1,1)
         points = np.concatenate((X, Y),axis=1).astype(int)
-        cluster = PointCluster(points, self.image)
+        cluster = PointCluster(points, self.image, frame_shape=self.frame_shape)
 
         if self.psf_bckg is None:
-            number_of_iterations = self.args.bkg_iterations
-            self.psf_bckg = sigma_clipper(self.image, iterations=number_of_iterations)
+            self.psf_bckg = psf_background(self.image, self.args)
 
         fit_function = self.args.fit_function
         square_size = (self.args.width, self.args.height)
@@ -153,7 +186,7 @@ class Serial:
         cluster.show_object_fit_separate = False
         cluster.add_background_data(self.psf_bckg)
         try:
-            cluster.fit_curve(function=fit_function, square_size=square_size)
+            cluster.fit_curve(function=fit_function, square_size=square_size, budget=self.args.fit_budget)
         except Exception as e:
             pass
 
@@ -163,6 +196,13 @@ class Serial:
                                  log=current.log,
                                  message='OK',
                                  code=0)
+        elif cluster.budget_reached:
+            iter = current.result.data[3]
+            return WrapperResult(result=DatabaseItem(cent_x, cent_y, iter=iter),
+                                 noise=-1,
+                                 log=current.log,
+                                 message='Fit budget reached.',
+                                 code=9)
         else:
             iter = current.result.data[3]
             return WrapperResult(result=DatabaseItem(cent_x, cent_y, iter=iter),
@@ -171,34 +211,82 @@ class Serial:
                                  message='Centre not right.',
                                  code=8)
 
+    def use_integral_image(self):
+        # box sums from summed-area tables need axis aligned boxes using all pixels,
+        # iteration log (verbose) needs all pixels of every iteration,
+        # the tables are read only by batched centroiding (perform_steps) of the sweep, cluster and sobel methods
+        return self.args.integral_image and self.args.angle == 0 and self.args.cent_pix_perc == 100 \
+            and self.args.verbose != 1 and self.args.batch_size > 1 \
+            and self.args.method in ('sweep', 'cluster', 'sobel')
+
     def is_point_object(self, current):
         return False
 
-    def perform_step(self, x,y):
+    def wrapper_parameters(self):
+        return dict(image=self.image,
+                    A=self.args.width,
+                    B=self.args.height,
+                    noise_dim=self.args.noise_dim,
+                    alpha=self.args.angle*np.pi/180,
+                    local_noise=self.args.local_noise,
+                    delta=self.args.delta,
+                    pix_lim=self.args.start_iter,
+                    pix_prop=self.args.cent_pix_perc,
+                    max_iter=self.args.max_iter,
+                    min_iter=self.args.min_iter,
+                    snr_lim=self.args.snr_lim,
+                    fine_iter=self.args.fine_iter,
+                    is_point=self.args.width == self.args.height)
+
+    def owns(self, x, y):
+        if self.owned is None:
+            return True
+
+        x_start, x_end, y_start, y_end = self.owned
+        return x_start <= x < x_end and y_start <= y < y_end
 
-        self.stats.started += 1
+    def perform_step(self, x,y):
 
-        wrapper = CentroidSimpleWrapper(image=self.image, 
-                                        init_x=x, 
-                                        init_y=y,
-                                        A=self.args.width,
-                                        B=self.args.height,
-                                        noise_dim=self.args.noise_dim,
-                                        alpha=self.args.angle*np.pi/180,
-                                        local_noise=self.args.local_noise,
-                                        delta=self.args.delta,
-                                        pix_lim=self.args.start_iter,
-                                        pix_prop=self.args.cent_pix_perc,
-                                        max_iter=self.args.max_iter,
-                                        min_iter=self.args.min_iter,
-                                        snr_lim=self.args.snr_lim,
-                                        fine_iter=self.args.fine_iter,
-                                        is_point=self.args.width == self.args.height)
+        wrapper = CentroidSimpleWrapper(init_x=x, init_y=y, **self.wrapper_parameters())
         current = wrapper.execute()
 
+        return self.finish_step(x, y, current)
+
+    def perform_steps(self, Xs, Ys):
+        # perform_step for independent seeds, centroiding is done in batches of args.batch_size seeds
+
+        batch_size = self.args.batch_size
+        if batch_size <= 1:
+            return [self.perform_step(x, y) for x, y in zip(Xs, Ys)]
+
+        steps = []
+        for i in range(0, len(Xs), batch_size):
+            X = Xs[i:i + batch_size]
+            Y = Ys[i:i + batch_size]
+
+            wrapper = CentroidBatchWrapper(init_x=X, init_y=Y, integral=self.integral, **self.wrapper_parameters())
+            results = wrapper.execute()
+
+            steps += [self.finish_step(x, y, current) for x, y, current in zip(X, Y, results)]
+
+        return steps
+
+    def perform_cluster_steps(self, X, Y, labels):
+        # perform_steps from the gravity centres of pixel clusters labelled 1..k, computed in one pass
+        Z = self.image[Y, X]
+
+        sumG = np.bincount(labels, weights=Z)[1:]
+        sumGx = np.bincount(labels, weights=Z * (X - 0.5))[1:]
+        sumGy = np.bincount(labels, weights=Z * (Y - 0.5))[1:]
+
+        return self.perform_steps(sumGx / sumG, sumGy / sumG)
+
+    def finish_step(self, x, y, current):
+
         if self.is_point_object(current):
-            wrapper.init_x = current.result.data[0]
-            wrapper.init_y = current.result.data[1]
+            wrapper = CentroidSimpleWrapper(init_x=current.result.data[0],
+                                            init_y=current.result.data[1],
+                                            **self.wrapper_parameters())
             wrapper.A = self.args.height
             wrapper.B = self.args.height
             wrapper.alpha = 0
@@ -219,23 +307,19 @@ class Serial:
             return Step(code=1, x=-1, y=-1)
          
     def update_statistics(self,x,y, current):
+        # seeds are counted by the tile owning the seed, objects are kept by the tile owning the centre
+        if not self.owns(x, y):
+            if current.code == 0 and self.owns(current.result.data[0], current.result.data[1]):
+                self.keep_object(x, y, current)
+            return
+
+        self.stats.started += 1
+
         if current.code == 0:
             self.stats.ok += 1
 
-            ud_code = self.database.update(current.result, self.args.centre_limit)
-
-            if ud_code == 1:
-                self.discarded.add(current.result)
-            else:
-                if self.args.verbose == 1 and self.args.parallel == 1:
-
-                    self.log(f'{x}, {y}\n')
-                    
-                    for line in current.log:
-                        for c in line:
-                            self.log(f"{c:.6f}\t")
-                        self.log('\n')
-                    self.log('\n')
+            if self.owns(current.result.data[0], current.result.data[1]):
+                self.keep_object(x, y, current)
         
         elif current.code == 1:
             self.stats.nulldata += 1
@@ -259,4 +343,27 @@ class Serial:
             self.stats.lowsnr += 1
 
         elif current.code == 8:
-            self.stats.notright += 1
\ No newline at end of file
+            self.stats.notright += 1
+
+        elif current.code == 9:
+            self.stats.fitbudget += 1
+
+    def keep_object(self, x, y, current):
+        ud_code = self.database.update(current.result, self.args.centre_limit)
+
+        if ud_code == 1:
+            self.discarded.add(current.result)
+        else:
+            if self.first_centroid is None:
+                self.first_centroid = time.time()
+
+            if self.args.verbose == 1 and self.owned is None:  # iteration log of serial runs only
+
+                self.log(f'{x}, {y}\n')
+                
+                for line in current.log:
+                    for c in line:
+                        self.log(f"{c:.6f}\t")
+                    self.log('\n')
+                self.log('\n')
+
@@ -1,6 +1,6 @@
 from utils.run_functions import remove_negative, brightness_error
-from processing.getPixels import get_pixels
-from processing.getGratvityCentre import find_gravity_centre
+from processing.getPixels import get_pixels, get_pixels_batch
+from processing.getGratvityCentre import find_gravity_centre, find_gravity_centres
 from copy import deepcopy
 from utils.structures import *
 
@@ -81,7 +81,7 @@ class CentroidSimpleWrapper:
         _, _, data_Z = get_pixels(self.init_x, self.init_y, self.A, self.B, self.alpha, self.image)
 
         # check the content of the rectangle
-        if np.nan in data_Z or data_Z == []:
+        if np.any(np.isnan(data_Z)) or len(data_Z) == 0:
             return WrapperResult(result=DatabaseItem(),
                               noise=-1,
                               log=None,
@@ -146,6 +146,11 @@ class CentroidSimpleWrapper:
             # count iteration
             iter += 1
 
+        return self.evaluate(current, iter, log)
+
+    def evaluate(self, current, iter, log) -> WrapperResult:
+        # checks and statistics of the centre found by the iteration
+
         # stop if did not finish iteration in time
         if iter > self.max_iter:
             return WrapperResult(result=DatabaseItem(current.center[0], current.center[0], iter=iter),
@@ -232,5 +237,123 @@ class CentroidSimpleWrapper:
                              message='OK',
                              code=0)
 
-        
-    
\ No newline at end of file
+
+class CentroidBatchWrapper(CentroidSimpleWrapper):
+    # runs CentroidSimpleWrapper for many seeds (INIT_X, INIT_Y are arrays) at once,
+    # the gravity centre iteration is done for all active candidates together and candidates
+    # that converged or were rejected are masked out, results are in the order of the seeds
+
+    def __init__(self, *args, integral=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.integral = integral  # IntegralImage for axis aligned boxes (optional)
+
+    def box_moments(self, current):
+        # sum, mean, variance, standard deviation, skewness and kurtosis of Z pixels of each box,
+        # only the sum and mean are known for boxes summed from the integral image
+        idx = current.index
+        n = len(current.count)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sum_Z = current.sum_Z
+            mu = sum_Z / current.count
+            dev = current.Z_pixels - mu[idx]
+            v = np.bincount(idx, weights=dev**2, minlength=n) / (current.count - 1)
+            s = np.sqrt(v)
+            sk = np.bincount(idx, weights=(dev / s[idx])**3, minlength=n) / current.count
+            ku = np.bincount(idx, weights=(dev / s[idx])**4, minlength=n) / current.count
+
+        for moment in (v, s, sk, ku):
+            moment[current.summed] = np.nan
+
+        return sum_Z, mu, v, s, sk, ku
+
+    def execute(self) -> List[WrapperResult]:
+
+        init_x = np.asarray(self.init_x, dtype=float).reshape(-1)
+        init_y = np.asarray(self.init_y, dtype=float).reshape(-1)
+        n = len(init_x)
+        results = [None] * n
+
+        _, _, data_Z, index = get_pixels_batch(init_x, init_y, self.A, self.B, self.alpha, self.image)
+
+        # check the content of the rectangles
+        count = np.bincount(index, minlength=n)
+        has_nan = np.bincount(index, weights=np.isnan(data_Z), minlength=n) > 0
+        max_Z = np.full(n, -np.inf)
+        filled = count > 0
+        if np.any(filled):
+            start = np.cumsum(count) - count
+            max_Z[filled] = np.maximum.reduceat(data_Z, start[filled])
+
+        null_data = has_nan | (count == 0)
+        not_enough = np.logical_not(null_data) & (count < 4)
+        not_bright = np.logical_not(null_data | not_enough) & (max_Z < self.pix_lim)
+
+        for i in np.flatnonzero(null_data):
+            results[i] = WrapperResult(result=DatabaseItem(), noise=-1, log=None, message='Null data', code=1)
+        for i in np.flatnonzero(not_enough):
+            results[i] = WrapperResult(result=DatabaseItem(), noise=-1, log=None, message='Not enough data', code=2)
+        for i in np.flatnonzero(not_bright):
+            results[i] = WrapperResult(result=DatabaseItem(), noise=-1, log=None, message='Not pixel bright enough', code=3)
+
+        # find gravity centres of the remaining candidates
+        active = np.flatnonzero(np.logical_not(null_data | not_enough | not_bright))
+
+        c_x = init_x.copy()
+        c_y = init_y.copy()
+        iters = np.ones(n, dtype=int)
+
+        # log iterations
+        logs = {i: [[c_x[i], c_y[i], 0, 0, 0, 0, 0, 0, 0, 0, 0]] for i in active}
+
+        while len(active) > 0:
+
+            current = find_gravity_centres(c_x[active], c_y[active], self.A, self.B, self.alpha, self.image, self.pix_prop,
+                                           integral=self.integral)
+
+            empty = current.count == 0
+            for i in active[empty]:
+                results[i] = WrapperResult(result=DatabaseItem(cent_x=c_x[i], cent_y=c_y[i]),
+                                           noise=-1,
+                                           log=logs[i],
+                                           message='Could not find gravity centre',
+                                           code=4)
+
+            # log attempt
+            sum_Z, mu, v, s, sk, ku = self.box_moments(current)
+            for k in np.flatnonzero(np.logical_not(empty)):
+                i = active[k]
+                logs[i].append([current.center_x[k], current.center_y[k], 0, iters[i], sum_Z[k], mu[k], v[k], s[k], sk[k], ku[k]])
+
+            # distance from previous centre
+            d_x = c_x[active] - current.center_x
+            d_y = c_y[active] - current.center_y
+            d = np.sqrt(d_x**2 + d_y**2)
+
+            # if too close or too many iterations, candidate is finished
+            finished = np.logical_not(empty) & ((d < self.delta) | (iters[active] > self.max_iter))
+
+            start = np.searchsorted(current.index, np.arange(len(active)))
+            for k in np.flatnonzero(finished):
+                i = active[k]
+                if current.summed[k]:
+                    X_pixels, Y_pixels, Z_pixels = get_pixels(c_x[i], c_y[i], self.A, self.B, self.alpha, self.image)
+                else:
+                    box = slice(start[k], start[k] + current.count[k])
+                    X_pixels, Y_pixels, Z_pixels = current.X_pixels[box], current.Y_pixels[box], current.Z_pixels[box]
+                grav = GravityCentreResult(center=(current.center_x[k], current.center_y[k]),
+                                           X_pixels=X_pixels,
+                                           Y_pixels=Y_pixels,
+                                           Z_pixels=Z_pixels)
+                results[i] = self.evaluate(grav, int(iters[i]), logs[i])
+
+            # new centre position of the candidates still iterating
+            going = np.logical_not(empty | finished)
+            c_x[active[going]] = current.center_x[going]
+            c_y[active[going]] = current.center_y[going]
+
+            # count iteration
+            active = active[going]
+            iters[active] += 1
+
+        return results
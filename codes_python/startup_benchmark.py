@@ -0,0 +1,57 @@
+# startup benchmark: runs main.py in fresh interpreters and reports the time to the first centroid
+# usage: python3 startup_benchmark.py [-R runs] -- [main.py options]
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def run_main(main_args):
+    # wall times of one run of main.py measured from the process start
+    t_start = time.time()
+    output = subprocess.run([sys.executable, 'main.py'] + main_args, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    t_end = time.time()
+
+    times = dict(re.findall(r'^(Init time|First centroid)\s*: ([0-9.]+) sec', output, re.MULTILINE))
+    if 'First centroid' not in times:
+        print(output)
+        raise RuntimeError('main.py did not report the first centroid')
+
+    return float(times['Init time']), float(times['First centroid']), t_end - t_start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-R', '--runs',
+                        type=int,
+                        default=5,
+                        help="Number of runs (default 5)")
+    parser.add_argument('main_args',
+                        nargs=argparse.REMAINDER,
+                        help="Options of main.py after --")
+    args = parser.parse_args()
+    main_args = args.main_args[1:] if args.main_args[:1] == ['--'] else args.main_args
+
+    # interpreter startup without any imports of the program
+    interpreter = []
+    for _ in range(args.runs):
+        t = time.time()
+        subprocess.run([sys.executable, '-c', 'pass'])
+        interpreter.append(time.time() - t)
+
+    runs = np.array([run_main(main_args) for _ in range(args.runs)])
+    init, first, total = np.median(runs, axis=0)
+    start = np.median(interpreter)
+
+    print("\n------- Startup ---------\n")
+    print(f'Runs                  : {args.runs}')
+    print(f'Interpreter startup   : {start:.4f} sec')
+    print(f'Imports and options   : {init:.4f} sec')
+    print(f'Time to first centroid: {start + first:.4f} sec')
+    print(f'Total time            : {total:.4f} sec')
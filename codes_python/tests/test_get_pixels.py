@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from processing.getPixels import get_pixels, rasterize_box, rasterize_box_rows
+
+SIZES = ((6, 6), (16, 6), (30, 3), (2.5, 0.5))
+
+
+def assert_same_pixels(result, expected):
+    for r, e in zip(result, expected):
+        assert r.dtype == e.dtype
+        np.testing.assert_array_equal(r, e)
+
+
+def centres(rng, A, nrow, ncol, samples):
+    # integer and sub-pixel centres inside the image, on its border and outside of it
+    inside = np.column_stack((rng.uniform(0, ncol, samples), rng.uniform(0, nrow, samples)))
+    border = np.column_stack((rng.choice([0.0, 0.5, ncol - 1.0, ncol - 0.5], samples), rng.uniform(0, nrow, samples)))
+    outside = np.column_stack((rng.uniform(-2 * A, ncol + 2 * A, samples), rng.uniform(-2 * A, nrow + 2 * A, samples)))
+    integer = np.floor(inside)
+
+    return np.concatenate((inside, border, outside, integer))
+
+
+@pytest.mark.parametrize('A, B', SIZES)
+def test_rasterizers_match_row_walk(A, B):
+    rng = np.random.default_rng(0)
+    image = rng.random((120, 90))
+    nrow, ncol = image.shape
+
+    for deg in range(0, 360, 3):
+        alpha = np.deg2rad(deg)
+        for cent_x, cent_y in centres(rng, A, nrow, ncol, 3):
+            expected = rasterize_box_rows(cent_x, cent_y, A, B, alpha, image)
+
+            assert_same_pixels(rasterize_box(cent_x, cent_y, A, B, alpha, image), expected)
+            assert_same_pixels(get_pixels(cent_x, cent_y, A, B, alpha, image), expected)
+
+
+def test_clipped_box_at_corners():
+    image = np.random.default_rng(1).random((60, 80))
+
+    for cent_x, cent_y in ((0, 0), (79, 0), (0, 59), (79, 59), (-3.3, 30.7), (40.2, 61.4)):
+        for deg in (0, 30, 45, 90, 135):
+            alpha = np.deg2rad(deg)
+            expected = rasterize_box_rows(cent_x, cent_y, 16, 6, alpha, image)
+
+            assert_same_pixels(rasterize_box(cent_x, cent_y, 16, 6, alpha, image), expected)
+            assert_same_pixels(get_pixels(cent_x, cent_y, 16, 6, alpha, image), expected)
+
+
+@pytest.mark.parametrize('cent_x, cent_y', ((np.nan, 30.0), (40.0, np.nan), (np.inf, 30.0), (40.0, -np.inf)))
+def test_no_pixels_without_centre(cent_x, cent_y):
+    # a box of zero sum has a NaN centre, no pixels are returned as by the row walk
+    image = np.random.default_rng(2).random((60, 80))
+
+    for X, Y, Z in (get_pixels(cent_x, cent_y, 6, 6, 0.0, image), rasterize_box(cent_x, cent_y, 6, 6, 0.0, image)):
+        assert len(X) == len(Y) == len(Z) == 0
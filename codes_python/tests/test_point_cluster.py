@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from processing.psf_segmentation.point_cluster import PointCluster
+
+SHAPE = (100, 100)
+BACKGROUND = 10.0
+
+
+def streak_image(x0, y0, width, length, rotation, total_flux):
+    # synthetic streak drawn by the fitted model itself, with gaussian noise
+    background = np.full(SHAPE, BACKGROUND)
+    model = PointCluster(np.zeros((1, 2), dtype=int), np.zeros(SHAPE))
+    model.background_data = background
+    image = model.veres((np.zeros(SHAPE),), x0, y0, width, length, rotation, total_flux).reshape(SHAPE)
+    return image + np.random.default_rng(0).normal(0, 1, SHAPE), background
+
+
+@pytest.mark.parametrize('x0, y0, width, length, rotation, total_flux',
+                         ((50.3, 49.6, 1.5, 40, 30, 20000), (47.8, 52.2, 2.0, 30, 70, 30000)))
+def test_veres_fit_of_streak(x0, y0, width, length, rotation, total_flux):
+    image, background = streak_image(x0, y0, width, length, rotation, total_flux)
+    rows, cols = np.where(image > BACKGROUND + 30)
+
+    cluster = PointCluster(np.column_stack((cols, rows)), image)
+    cluster.add_background_data(background)
+    cluster.fit_curve('veres', square_size=(61, 61))
+
+    assert cluster.correct_fit
+    assert cluster.x0 == pytest.approx(x0, abs=0.1)
+    assert cluster.y0 == pytest.approx(y0, abs=0.1)
+    assert cluster.fwhm_x == pytest.approx(length, rel=0.05)
+    assert cluster.fwhm_y == pytest.approx(2 * np.sqrt(2 * np.log(2)) * width, rel=0.05)
+    assert cluster.x0_err is not None and cluster.total_err < 0.1
+
+    # the database item of the fit is complete
+    item = cluster.output_database_item()
+    assert item is not None
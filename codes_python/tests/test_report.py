@@ -0,0 +1,119 @@
+import concurrent.futures
+import json
+import multiprocessing
+import sys
+import types
+
+import numpy as np
+
+from utils.structures import Database
+from utils import report
+
+
+def make_database(points):
+    database = Database()
+    data = np.zeros((len(points), len(Database.col_names)))
+    data[:, :2] = points
+    data[:, 4] = np.arange(len(points)) + 100
+    database.data = data
+    return database
+
+
+def test_matched_catalog_of_wide_model(tmp_path):
+    # a previous result (11 columns) used as the model
+    found = np.array([[10.0, 10.0], [50.0, 50.0], [90.0, 20.0]])
+    model = np.zeros((3, 11))
+    model[:, :2] = found + 0.25
+    model[:, 2] = [1000, 2000, 3000]
+    model[:, 3:] = 7
+    model_file = tmp_path / 'model.tsv'
+    np.savetxt(model_file, model, delimiter='\t')
+
+    database = make_database(found)
+    args = types.SimpleNamespace(model=str(model_file), match_limit=1.0)
+    result = report.match_report(database, args)
+    assert len(result.matched) == 3
+
+    output = str(tmp_path / 'out')
+    result.write_catalog(output, database, ['tsv', 'json', 'npy'])
+
+    expected = np.concatenate((found, [[100], [101], [102]], model[:, :3]), axis=1)
+
+    tsv = np.loadtxt(output + '_matched.tsv', skiprows=1, ndmin=2)
+    assert tsv.shape == (3, 6)
+    np.testing.assert_allclose(tsv[np.argsort(tsv[:, 0])], expected, rtol=1e-6)
+
+    with open(output + '_matched.json') as f:
+        rows = [json.loads(line) for line in f]
+    assert [list(row) for row in rows] == [list(Database.col_names[:2]) + ['sum', 'cat.x', 'cat.y', 'cat.sum']] * 3
+    assert sorted(float(row['cat.sum']) for row in rows) == [1000, 2000, 3000]
+
+    table = np.load(output + '_matched.npy')
+    assert table.dtype.names == ('cent.x', 'cent.y', 'sum', 'cat.x', 'cat.y', 'cat.sum')
+    np.testing.assert_allclose(np.sort(table['cat.sum']), [1000, 2000, 3000])
+
+
+def test_background_report_without_fork(monkeypatch):
+    # with running threads the report is not forked, it is written as with --report sync
+    written = []
+    monkeypatch.setattr(report, 'write_pdf', lambda *args: written.append(args))
+    monkeypatch.setattr(report.threading, 'active_count', lambda: 2)
+
+    report.write_pdf_background('database', 'image', 'args', 'report')
+    assert written == [('database', 'image', 'args', 'report')]
+    assert report.background_reports == []
+
+
+def test_background_report_in_pool(monkeypatch):
+    # the report of a batch is written by a worker of its pool
+    written = []
+    monkeypatch.setattr(report, 'write_pdf_process', lambda *args: written.append(args))
+    args = types.SimpleNamespace(input='frame.fit')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        report.write_pdf_background('database', 'image', args, 'report', executor=executor)
+        report.wait_reports()
+
+    assert written == [('database', 'image', args, 'report')]
+    assert report.background_reports == []
+    assert report.take_report_errors() == []
+
+
+def test_failed_background_reports_keep_their_frames(monkeypatch):
+    # failures of a pool worker and of a forked process are kept with the frames of the reports
+    def fail(database, image, args, report):
+        raise ValueError(args.input)
+
+    monkeypatch.setattr(report, 'write_pdf_process', fail)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        report.write_pdf_background(None, None, types.SimpleNamespace(input='first.fit'), None, executor=executor)
+        report.write_pdf_background(None, None, types.SimpleNamespace(input='second.fit'), None, executor=executor)
+        report.wait_reports()
+
+    process = multiprocessing.get_context('fork').Process(target=sys.exit, args=(3,))
+    process.start()
+    report.background_reports.append(('third.fit', process))
+    report.wait_reports()
+
+    errors = report.take_report_errors()
+    assert [frame for frame, _ in errors] == ['first.fit', 'second.fit', 'third.fit']
+    assert str(errors[0][1]) == 'first.fit'
+    assert 'code 3' in errors[2][1]
+    assert report.take_report_errors() == []
+
+
+def test_match_to_closest_free_star(tmp_path):
+    # both found stars are closest to the first model star, the lower index takes it (equal distances)
+    model = np.array([[0.5, 0.0, 1.0], [10.0, 0.0, 2.0], [3.0, 0.0, 3.0]])
+    model_file = tmp_path / 'model.tsv'
+    np.savetxt(model_file, model, delimiter='\t')
+
+    database = make_database(np.array([[0.0, 0.0], [1.0, 0.0], [3.2, 0.0]]))
+    args = types.SimpleNamespace(model=str(model_file), match_limit=1.0)
+    _, matched, unmatched = report.match_objects(database, args)
+
+    assert matched.tolist() == [[2, 2], [0, 0]]
+    # the distance of an unmatched star is to the nearest model star left free
+    assert unmatched[:, 0].tolist() == [1]
+    np.testing.assert_allclose(unmatched[:, 1], [9.0])
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from processing import run_parallel
+
+
+class FailingSerial:
+    # keeps a view of the shared image as Serial does and fails in execute
+    def __init__(self, args, image, **kwargs):
+        self.image = image
+
+    def execute(self, index, owned):
+        raise RuntimeError('tile failed')
+
+
+def test_tile_error_is_not_hidden_by_shared_memory(monkeypatch):
+    monkeypatch.setattr(run_parallel.run_serial, 'Serial', FailingSerial)
+    shm, info = run_parallel.share_image(np.arange(100.0).reshape(10, 10))
+    try:
+        arg = ((0, 9, 0, 9), None, None, info, None, None, (10, 10), None)
+        with pytest.raises(RuntimeError, match='tile failed'):
+            run_parallel.execute_serial(arg)
+    finally:
+        shm.close()
+        shm.unlink()
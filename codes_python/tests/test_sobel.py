@@ -0,0 +1,37 @@
+import numpy as np
+
+from processing.psf_segmentation.sobel import join_neigbor_points_mask
+
+
+def flood_fill_clusters(mask):
+    # 4-connected clusters found by a flood fill from the first pixel of every cluster (row by row)
+    mask = mask.copy()
+    clusters = []
+    for y, x in zip(*np.nonzero(mask)):
+        if not mask[y, x]:
+            continue
+        mask[y, x] = False
+        cluster, stack = [(x, y)], [(x, y)]
+        while stack:
+            x_p, y_p = stack.pop()
+            for x_n, y_n in ((x_p - 1, y_p), (x_p + 1, y_p), (x_p, y_p - 1), (x_p, y_p + 1)):
+                if 0 <= x_n < mask.shape[1] and 0 <= y_n < mask.shape[0] and mask[y_n, x_n]:
+                    mask[y_n, x_n] = False
+                    stack.append((x_n, y_n))
+                    cluster.append((x_n, y_n))
+        clusters.append(sorted(cluster))
+    return clusters
+
+
+def test_clusters_match_flood_fill():
+    rng = np.random.default_rng(1)
+    for _ in range(50):
+        mask = rng.random((rng.integers(1, 60), rng.integers(1, 60))) < rng.uniform(0.05, 0.7)
+
+        clusters = join_neigbor_points_mask(mask)
+
+        assert [sorted(zip(X.tolist(), Y.tolist())) for X, Y in clusters] == flood_fill_clusters(mask)
+
+
+def test_empty_mask_has_no_clusters():
+    assert join_neigbor_points_mask(np.zeros((20, 30), dtype=bool)) == []
@@ -0,0 +1,35 @@
+from astropy.io import fits
+import numpy as np
+
+
+class Frame:
+    # FITS frame opened once, the header is read on opening and the data only when needed:
+    # the whole image by data() or parts of it by section() (only the rows of the part are read)
+    # memmap is not used, astropy cannot memory-map scaled (BZERO/BSCALE) images
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.hdul = fits.open(filename, memmap=False)
+        self.hdu = self.hdul[0]
+        self.header = self.hdu.header
+        self.shape = tuple(self.hdu.shape)
+        self.image = None
+
+    def data(self):
+        # whole image, read on the first call
+        if self.image is None:
+            self.image = self.hdu.data
+        return self.image
+
+    def section(self, x_start, x_end, y_start, y_end):
+        # part of the image with inclusive borders clipped to the image, returns the part and its origin (x, y)
+        x_start, y_start = max(int(x_start), 0), max(int(y_start), 0)
+        x_end, y_end = min(int(x_end), self.shape[1] - 1), min(int(y_end), self.shape[0] - 1)
+
+        if self.image is not None:
+            return self.image[y_start:y_end + 1, x_start:x_end + 1], (x_start, y_start)
+
+        return np.asarray(self.hdu.section[y_start:y_end + 1, x_start:x_end + 1]), (x_start, y_start)
+
+    def close(self):
+        self.hdul.close()
@@ -1,17 +1,24 @@
 import matplotlib.pyplot as plt
 import matplotlib as mpl
-from scipy.stats import gaussian_kde
 import numpy as np
 import scipy
 from matplotlib.backends.backend_pdf import PdfPages
-import matplotlib
-from scipy.spatial import distance
+from matplotlib.collections import PolyCollection
+import multiprocessing
+import sys
+import threading
+from scipy.spatial import cKDTree
 from scipy.stats import norm, gaussian_kde
 from utils.run_functions import rms
 from utils.structures import Report, Configuration
 
 # MATCH_LIMIT = 1
 
+# report processes running in the background, at most one at a time, with the input frame of each report
+background_reports = []
+# (input frame, error) of the background reports that failed, taken by take_report_errors
+report_errors = []
+
 
 def parse_cat(filename):
     points = []
@@ -45,58 +52,89 @@ def match_objects(database, params):
     if '.cat' == params.model[-4:]:
         model = parse_cat(params.model)
     else:
-        model = np.genfromtxt(params.model, delimiter='\t')
+        model = np.genfromtxt(params.model, delimiter='\t', ndmin=2)
 
     matched = []
     unmatched = []
     if model is not None:
-        found_points = database.data[:, 0:2].astype(np.float32)
+        found_points = database.data[:, 0:2].astype(np.float32).astype(float)
         model_points = model[:, 0:2]
 
-        # idx = np.argsort(found_points[:,0])
-        # found_points = found_points[idx]
-
-        dist = distance.cdist(found_points, model_points, 'euclidean')
-
-        min_idx = np.argmin(dist, axis=1)
-        min_value = np.min(dist, axis=1)
-
-        processed = set()
-        used = set()
-        i = 0
+        # points without a position (e.g. a header line of the model) are never matched
+        found_idx = np.flatnonzero(np.all(np.isfinite(found_points), axis=1))
+        model_idx = np.flatnonzero(np.all(np.isfinite(model_points), axis=1))
+
+        # pairs closer than the match limit from the trees (radius widened by the rounding of the tree distances),
+        # the limit is applied to the distances computed as by cdist
+        found_tree = cKDTree(found_points[found_idx])
+        model_tree = cKDTree(model_points[model_idx])
+        pairs = found_tree.sparse_distance_matrix(model_tree, params.match_limit * (1 + 1e-9), output_type='ndarray')
+
+        i = found_idx[pairs['i']]
+        j = model_idx[pairs['j']]
+        dist = np.sqrt(np.sum((found_points[i] - model_points[j]) ** 2, axis=1))
+        close = dist <= params.match_limit
+        i, j, dist = i[close], j[close], dist[close]
+
+        # greedy one-to-one assignment: pairs from the closest, a pair is taken when both stars are free
+        # pairs first in the order for both of their stars are taken together, pairs of taken stars are dropped
+        order = np.lexsort((j, i, dist))
+        i, j = i[order], j[order]
+        pos = np.arange(len(order))
+        taken = []
+        free_found = np.ones(len(found_points), dtype=bool)
+        free_model = np.ones(len(model_points), dtype=bool)
+        while len(pos) > 0:
+            # first remaining pair of every star
+            first_found = np.full(len(found_points), len(order))
+            np.minimum.at(first_found, i[pos], pos)
+            first_model = np.full(len(model_points), len(order))
+            np.minimum.at(first_model, j[pos], pos)
+            take = pos[(first_found[i[pos]] == pos) & (first_model[j[pos]] == pos)]
+            taken.append(take)
+            free_found[i[take]] = False
+            free_model[j[take]] = False
+            pos = pos[free_found[i[pos]] & free_model[j[pos]]]
+
+        if taken:
+            take = np.sort(np.concatenate(taken))  # in the order of the distances
+            matched = np.column_stack((i[take], j[take])).tolist()
+
+        # found stars without a match with the distance to the nearest model star left free by the matching
+        # (inf when there is none)
+        rest = np.flatnonzero(free_found)
+        nearest = np.full(len(rest), np.inf)
+        free_idx = model_idx[free_model[model_idx]]
+        if len(free_idx) > 0:
+            finite = np.isin(rest, found_idx)
+            nearest[finite] = cKDTree(model_points[free_idx]).query(found_points[rest[finite]])[0]
+        unmatched = [[r, d] for r, d in zip(rest, nearest)]
 
-        while len(processed) != len(dist):
-
-            if i in processed:
-                i += 1
-                continue
+    return model, np.array(matched), np.array(unmatched)
 
-            if min_value[i] > params.match_limit:
-                unmatched.append([i, min_value[i]])
-                processed.add(i)
-                i += 1
-                continue
 
-            model_min_idx = np.argmin(min_value)
+def rectangles(centres, args: Configuration):
+    # corners of the centroiding rectangles around CENTRES rotated by the angle, shape (n, 4, 2)
+    angle = np.radians(args.angle)
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * [args.width, args.height]
+    rotation = np.array([[np.cos(angle), np.sin(angle)], [-np.sin(angle), np.cos(angle)]])
 
-            if min_idx[model_min_idx] in used:
-                # is used
-                min_value[model_min_idx] = np.min(dist[model_min_idx])
-                min_idx[model_min_idx] = np.argmin(dist[model_min_idx])
-            else:
-                # is free
-                # set a match
+    return centres[:, np.newaxis, :] + (corners @ rotation)[np.newaxis, :, :]
 
-                matched.append([model_min_idx, min_idx[model_min_idx]])
 
-                # mark as used
-                used.add(min_idx[model_min_idx])
-                dist[:, min_idx[model_min_idx]] = 1000
+def downsample(image, fig):
+    # mean of FACTOR x FACTOR blocks, the result has at least the pixels of the figure at its dpi
+    width, height = fig.get_size_inches() * fig.dpi
+    factor = max(1, int(min(image.shape[1] / width, image.shape[0] / height)))
+    if factor == 1:
+        return image, 1
 
-                processed.add(model_min_idx)
-                min_value[model_min_idx] = 1000
+    rows = -(-image.shape[0] // factor)
+    cols = -(-image.shape[1] // factor)
+    padded = np.pad(image.astype(float), ((0, rows*factor - image.shape[0]), (0, cols*factor - image.shape[1])),
+                    mode='edge')
 
-    return model, np.array(matched), np.array(unmatched)
+    return padded.reshape(rows, factor, cols, factor).mean(axis=(1, 3)), factor
 
 
 def draw_picture(database, image, args: Configuration, model):
@@ -115,30 +153,26 @@ def draw_picture(database, image, args: Configuration, model):
     fig.colorbar(mpl.cm.ScalarMappable(norm=norm, cmap=cmap),
                  ax=ax, label='SNR')
 
+    # all rectangles of the model and of the found objects are drawn as two collections
     if model is not None:
-        for i, data in enumerate(model[:, 0:2]):
-            x, y = data
-            rec = matplotlib.patches.Rectangle((x -  args.width, y - args.height), 2*args.width, 2*args.height,
-                                               edgecolor='white', facecolor="none", linewidth=0.5)
-            t = matplotlib.transforms.Affine2D().rotate_deg_around(x, y, args.angle) + ax.transData
-            rec.set_transform(t)
-            ax.add_patch(rec)
-
-    for i, data in enumerate(database.data[:, 0:2]):
-        color = cmap(norm(col_data[i]))
-        x, y = data
-        rec = matplotlib.patches.Rectangle((x - args.width, y - args.height), 2*args.width, 2*args.height,
-                                           edgecolor=color, facecolor="none", linewidth=0.5, linestyle='dotted')
-        t = matplotlib.transforms.Affine2D().rotate_deg_around(x, y, args.angle) + ax.transData
-        rec.set_transform(t)
-        ax.add_patch(rec)
+        ax.add_collection(PolyCollection(rectangles(model[:, 0:2], args), edgecolors='white', facecolors='none',
+                                         linewidths=0.5))
+
+    ax.add_collection(PolyCollection(rectangles(database.data[:, 0:2], args), edgecolors=cmap(norm(col_data)),
+                                     facecolors='none', linewidths=0.5, linestyles='dotted'))
 
     image_mean = np.mean(image)
     vmin = np.min(image)
     sigma = np.std(image)
     vmax = image_mean + 2*sigma
 
-    ax.imshow(image, cmap='gray', origin='lower', vmin=vmin, vmax=vmax)
+    # the image is reduced to about the resolution of the figure, the extent keeps the pixel coordinates
+    shown, factor = downsample(image, fig)
+    height, width = image.shape
+    ax.imshow(shown, cmap='gray', origin='lower', vmin=vmin, vmax=vmax,
+              extent=(-0.5, shown.shape[1] * factor - 0.5, -0.5, shown.shape[0] * factor - 0.5))
+    ax.set_xlim(-0.5, width - 0.5)
+    ax.set_ylim(-0.5, height - 0.5)
 
     return fig
 
@@ -193,18 +227,23 @@ def iter_hist(database):
     return fig
 
 
-def model_hist(database, model, matched):
-    fig = plt.figure()
-    axs = fig.subplots(2, 2)
-
-    X, Y = np.array([]), np.array([])
-
+def match_errors(database, model, matched):
+    # X and Y differences of the matched objects from the model
     X = database.data[matched[:, 0], 0] - model[matched[:, 1], 0]
     X = X.astype(np.float32).reshape(-1)
-    create_hist(X, title=f'X axis differences {np.mean(X):.4f}', ax=axs[0][0], xlabel='X difference')
 
     Y = database.data[matched[:, 0], 1] - model[matched[:, 1], 1].astype(np.float32)
     Y = Y.astype(np.float32)
+
+    return X, Y
+
+
+def model_hist(database, model, matched):
+    fig = plt.figure()
+    axs = fig.subplots(2, 2)
+
+    X, Y = match_errors(database, model, matched)
+    create_hist(X, title=f'X axis differences {np.mean(X):.4f}', ax=axs[0][0], xlabel='X difference')
     create_hist(Y, title=f'Y axis differences {np.mean(Y):.4f}', ax=axs[0][1], xlabel='Y difference')
 
     E = np.sqrt(X ** 2 + Y ** 2)
@@ -272,6 +311,14 @@ def no_matched_text():
     return fig
 
 def generate_report(database, image, args):
+    report = match_report(database, args)
+    write_pdf(database, image, args, report)
+
+    return report
+
+
+def match_report(database, args):
+    # matching with the model, the report without the figures
     if args.model is not None and args.model != "":
         model, matched, unmatched = match_objects(database, args)
     else:
@@ -279,6 +326,24 @@ def generate_report(database, image, args):
         matched = np.array([])
         unmatched = np.array([])
 
+    X, Y = None, None
+    if model is not None and len(matched) > 0:
+        X, Y = match_errors(database, model, matched)
+
+    return Report(matched=matched,
+                  unmatched=unmatched,
+                  model=model,
+                  X=np.mean(X) if X is not None else 0,
+                  Y=np.mean(Y) if Y is not None else 0,
+                  rms_x=rms(X) if X is not None else 0,
+                  rms_y=rms(Y) if Y is not None else 0
+                  )
+
+
+def write_pdf(database, image, args, report):
+    # figures of the report to <output>.pdf
+    model, matched = report.model, report.matched
+
     # iter_hist(database)
 
     f_image = draw_picture(database, image, args, model)
@@ -288,7 +353,6 @@ def generate_report(database, image, args):
     pp.savefig(f_image)
     pp.savefig(f_hist)
 
-    X, Y = None, None
     if model is not None:
 
         if len(matched) > 0:
@@ -308,12 +372,51 @@ def generate_report(database, image, args):
             pp.savefig(f_no_matched)
 
     pp.close()
-    return Report(matched=matched,
-                  unmatched=unmatched,
-                  model=model,
-                  X=np.mean(X) if X is not None else 0,
-                  Y=np.mean(Y) if Y is not None else 0,
-                  rms_x=rms(X) if X is not None else 0,
-                  rms_y=rms(Y) if Y is not None else 0
-                  )
+    plt.close('all')
+
+
+def write_pdf_background(database, image, args, report, executor=None):
+    # the pdf is written by another process with a non-interactive backend, the caller continues
+    # with the next frame, a new report waits for the previous one
+    # the process is a worker of EXECUTOR (batch) or a fork of this process, main.py and batch.py
+    # cannot be imported again by spawned processes; without fork or with running threads the pdf
+    # is written here as with --report sync
+    wait_reports()
+
+    if executor is not None:
+        background_reports.append((args.input, executor.submit(write_pdf_process, database, image, args, report)))
+    elif 'fork' in multiprocessing.get_all_start_methods() and threading.active_count() == 1:
+        sys.stdout.flush()  # buffered output would be printed by the child again
+        process = multiprocessing.get_context('fork').Process(target=write_pdf_process, args=(database, image, args, report))
+        process.start()
+        background_reports.append((args.input, process))
+    else:
+        print('Report written in this process, fork is not available or not safe with threads')
+        write_pdf(database, image, args, report)
+
+
+def write_pdf_process(database, image, args, report):
+    plt.switch_backend('Agg')
+    write_pdf(database, image, args, report)
+
+
+def wait_reports():
+    # waits for the background reports, failures are kept in report_errors with the frames of the reports
+    while background_reports:
+        frame, background = background_reports.pop(0)
+        if isinstance(background, multiprocessing.process.BaseProcess):
+            background.join()
+            if background.exitcode != 0:
+                report_errors.append((frame, f'report process exited with code {background.exitcode}'))
+        else:
+            try:
+                background.result()
+            except Exception as e:
+                report_errors.append((frame, e))
+
 
+def take_report_errors():
+    # failures of the finished background reports not taken yet
+    errors = report_errors[:]
+    report_errors.clear()
+    return errors
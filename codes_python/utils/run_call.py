@@ -29,6 +29,23 @@ def save_call(args):
     data += '--centre-limit ' + str(args.centre_limit) + ' '
     data += '--match-limit ' + str(args.match_limit) + ' '
     data += '--pixscale ' + str(args.pixscale) + ' '
+    data += '--batch-size ' + str(args.batch_size) + ' '
+    data += '--integral-image ' + str(args.integral_image) + ' '
+    data += '--max-order ' + str(args.max_order) + ' '
+    data += '--bkg-method ' + str(args.bkg_method) + ' '
+    data += '--bkg-box ' + str(args.bkg_box) + ' '
+    data += '--fit-budget ' + str(args.fit_budget) + ' '
+    data += '--sections ' + str(args.sections) + ' '
+    data += '--report ' + str(args.report) + ' '
+    data += '--catalog ' + str(args.catalog) + ' '
+    if args.bkg_cache is not None:
+        data += '--bkg-cache ' + str(args.bkg_cache) + ' '
+    if args.halo is not None:
+        data += '--halo ' + str(args.halo) + ' '
+    if args.workers is not None:
+        data += '--workers ' + str(args.workers) + ' '
+    if args.tile_size is not None:
+        data += '--tile-size ' + str(args.tile_size) + ' '
 
 
 
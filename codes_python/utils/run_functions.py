@@ -1,6 +1,7 @@
 from utils.structures import *
 from typing import List
 import math
+from numpy.lib.recfunctions import unstructured_to_structured
 from utils.structures import SerialResult
 
 
@@ -14,17 +15,25 @@ def remove_negative(v, val):
     return v
 
 
-def combine_results(results: List[SerialResult]):
+def combine_results(results: List[SerialResult], centre_limit=0):
     names = ('cent.x', 'cent.y', 'snr', 'iter', 'sum', 'mean', 'var', 'std', 'skew', 'kurt', 'bckg')
     database = Database()
     discarded = Database()
 
     stats = Stats()
 
-    for result in results:
-        database = database.concatenate(result.database)
-        discarded = discarded.concatenate(result.discarded)
+    database = database.concatenate(*[result.database for result in results])
+    discarded = discarded.concatenate(*[result.discarded for result in results])
+
+    if centre_limit > 0:
+        # objects of neighbouring tiles closer than CENTRE_LIMIT are merged as in one serial run
+        merged = Database()
+        for row in database.data:
+            if merged.update(row, centre_limit) == 1:
+                discarded.add(row)
+        database = merged
 
+    for result in results:
         stats.started += result.stats.started
         stats.nulldata += result.stats.nulldata
         stats.notenough += result.stats.notenough
@@ -35,8 +44,12 @@ def combine_results(results: List[SerialResult]):
         stats.lowsnr += result.stats.lowsnr
         stats.ok += result.stats.ok
         stats.notright += result.stats.notright
+        stats.fitbudget += result.stats.fitbudget
+
+    first = [result.first_centroid for result in results if result.first_centroid is not None]
 
-    return SerialResult(database=database, discarded=discarded, stats=stats)
+    return SerialResult(database=database, discarded=discarded, stats=stats,
+                        first_centroid=min(first) if first else None)
 
 
 def rms(X, predicted=None):
@@ -71,16 +84,49 @@ def brightness_error(Is, Ns, n_pix, n_b):
     return np.sqrt(Is + n_pix * (1 + (n_pix / n_b)) * Ns)
 
 
+def text_columns(data):
+    # columns of the 2D DATA as lists of text (as numpy prints the values), values repeated in a column
+    # (inf, flags, counts) are converted once
+    # the shortest text of a float (about 1 us per value) is most of the time of text catalogs, npy has no conversion
+    data = np.asarray(data)
+    columns = []
+    for column in data.T:
+        if column.dtype.kind == 'f':
+            # unique bit patterns, -0.0 and 0.0 are printed differently
+            unique, inverse = np.unique(column.view(f'i{column.itemsize}'), return_inverse=True)
+            if 2 * len(unique) <= len(column):
+                columns.append(unique.view(column.dtype).astype(str)[inverse.reshape(-1)].tolist())
+                continue
+
+        columns.append(column.astype(str).tolist())
+
+    return columns
+
+
 def write_tsv(filename, col_names, data):
-    data = data.astype(str)
+    write_tsv_columns(filename, col_names, text_columns(data))
+
+
+def write_tsv_columns(filename, col_names, columns):
+    # COLUMNS are lists of text, the file is written at once
+    lines = ['\t'.join(col_names)] + ['\t'.join(row) for row in zip(*columns)]
     with open(filename + '.tsv', 'w') as f:
-        print('\t'.join(col_names), file=f)
-        for line in data:
-            print('\t'.join(line.astype(str)), file=f)
+        f.write('\n'.join(lines) + '\n')
 
 
 def write_json(filename, col_names, data):
-    data = data.astype(str)
+    write_json_columns(filename, col_names, text_columns(data))
+
+
+def write_json_columns(filename, col_names, columns):
+    # one object per line with the values as strings, the values are numbers or None (no escaping needed)
+    line = '{' + ', '.join(f'{json.dumps(name)}: "%s"' for name in col_names) + '}\n'
     with open(filename + '.json', 'w') as f:
-        for line in data:
-            print(json.dumps({n: v for n, v in zip(col_names, line)}), file=f)
+        f.write(''.join(line % row for row in zip(*columns)))
+
+
+def write_npy(filename, col_names, data):
+    # structured float64 array with fields COL_NAMES, np.load(filename + '.npy', mmap_mode='r') maps it
+    data = np.asarray(data, dtype=float).reshape(-1, len(col_names))
+    table = unstructured_to_structured(data, dtype=np.dtype([(name, float) for name in col_names]))
+    np.save(filename + '.npy', table)
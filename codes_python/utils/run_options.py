@@ -1,8 +1,16 @@
 import argparse
 from utils.structures import Configuration
+from utils.frame import Frame
+import glob
 import os
 import sys
 
+FITS_EXTENSIONS = ('.fit', '.fits', '.fts')
+CATALOG_FORMATS = ('tsv', 'json', 'npy')
+REPORT_MODES = ('sync', 'background', 'none')
+MAX_ORDERS = ('raster', 'brightness')
+BKG_METHODS = ('sigma', 'mesh')
+
 def str2bool(v):
     if isinstance(v, bool):
        return v
@@ -14,6 +22,56 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 def read_arguments():
+    args = build_parser().parse_args()
+    cfg = read_config(args)
+
+    # the input file is opened once, the header here and the data later
+    frame = Frame(cfg.input)
+
+    missing = read_frame_arguments(cfg, args, frame)
+    for name in missing:
+        print(f'Missing input parameter {name}')
+
+    if missing:
+        sys.exit(1)
+
+    return cfg, frame
+
+def read_batch_arguments():
+    # arguments of batch.py, the options of main.py and FITS files, directories, globs or list files (@list.txt)
+    parser = build_parser()
+    parser.add_argument('frames',
+                        nargs='*',
+                        help="Input FITS files, directories, glob patterns or @files with one path per line")
+
+    args = parser.parse_args()
+    frames = expand_inputs(args.frames + ([args.input] if args.input else []))
+    del args.frames  # not a configuration field
+
+    cfg = read_config(args)
+
+    return cfg, args, frames
+
+def expand_inputs(items):
+    # FITS files of the batch in the given order, directories and globs are sorted, duplicates are dropped
+    frames = []
+    for item in items:
+        if item.startswith('@'):
+            with open(item[1:], 'r') as f:
+                paths = expand_inputs([line.strip() for line in f if line.strip() and not line.startswith('#')])
+        elif os.path.isdir(item):
+            paths = sorted(os.path.join(item, name) for name in os.listdir(item)
+                           if os.path.splitext(name)[1].lower() in FITS_EXTENSIONS)
+        elif glob.has_magic(item):
+            paths = sorted(glob.glob(item))
+        else:
+            paths = [item]
+
+        frames += [path for path in paths if path not in frames]
+
+    return frames
+
+def build_parser():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-F', '--input',
@@ -109,7 +167,7 @@ def read_arguments():
     parser.add_argument("-P", "--parallel",
                         type    = int,
                         default = None,
-                        help    = "Split image into PxP parts and process parallely (default 1)")
+                        help    = "Split image into PxP parts and process parallely, see --tile-size and --workers (default 1)")
 
     parser.add_argument("-V", "--verbose",
                         type    = int,
@@ -153,9 +211,64 @@ def read_arguments():
                         type=float,
                         default=None,
                         help="Pixel scale")
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=None,
+                        help="Number of seeds centroided together, 1 for one seed at a time (default 4096)")
+    parser.add_argument('--integral-image',
+                        type=str2bool,
+                        default=None,
+                        help="Use summed-area tables for centroiding when angle is 0 and cent-pix-perc is 100 (default False)")
+    parser.add_argument('--halo',
+                        type=float,
+                        default=None,
+                        help="Overlap of parallel tiles in pixels (default 2*max(width, height) + noise dim)")
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help="Number of parallel processes, at most the CPU count (default P*P)")
+    parser.add_argument('--tile-size',
+                        type=int,
+                        default=None,
+                        help="Size of parallel tiles in pixels (default image split into PxP tiles)")
+    parser.add_argument('--max-order',
+                        type=str,
+                        default=None,
+                        help="Order of candidates of the max method (raster, brightness) (default raster)")
+    parser.add_argument('--bkg-method',
+                        type=str,
+                        default=None,
+                        help="Background estimation for psf (sigma, mesh) (default sigma)")
+    parser.add_argument('--bkg-box',
+                        type=int,
+                        default=None,
+                        help="Block size of the mesh background in pixels (default 64)")
+    parser.add_argument('--bkg-cache',
+                        type=str,
+                        default=None,
+                        help="Directory to cache background maps of frames, none for no cache (default none)")
+    parser.add_argument('--fit-budget',
+                        type=int,
+                        default=None,
+                        help="Maximal number of function evaluations of one psf fit (default 10000)")
+    parser.add_argument('--sections',
+                        type=str2bool,
+                        default=None,
+                        help="Parallel workers read only their tiles from the input file (default False)")
+    parser.add_argument('--report',
+                        type=str,
+                        default=None,
+                        help="PDF report after the catalog (sync, background, none) (default sync)")
+    parser.add_argument('--catalog',
+                        type=str,
+                        default=None,
+                        help="Comma separated formats of the result catalogs (tsv, json, npy) (default tsv,json), "
+                             "npy is recommended for large frames, its writing does not convert values to text")
 
-    args : Configuration = parser.parse_args()
+    return parser
 
+def read_config(args):
+    # configuration from the json file overridden by the given command line options
     if args.json_config is None:
         path = os.path.dirname(os.path.abspath(__file__))
         path = os.path.join(path, f'../resources/default_config.json')
@@ -171,35 +284,38 @@ def read_arguments():
         if args.__dict__[name] is not None:
             cfg.__dict__[name] = args.__dict__[name]
 
+    for name in cfg.catalog.split(','):
+        if name not in CATALOG_FORMATS:
+            print(f'Unknown catalog format {name}')
+            sys.exit(1)
+
+    # values of the options from the command line or the json file
+    for option, value, values in (('--report', cfg.report, REPORT_MODES),
+                                  ('--max-order', cfg.max_order, MAX_ORDERS),
+                                  ('--bkg-method', cfg.bkg_method, BKG_METHODS)):
+        if value not in values:
+            print(f'Unknown {option} value {value} (one of {", ".join(values)})')
+            sys.exit(1)
+
+    return cfg
+
+def read_frame_arguments(cfg : Configuration, args, frame):
+    # parameters missing on the command line are read from the FRAME header, returns the names still missing
     if args.width is None or args.angle is None:
         try:
-            width, angle = read_from_fits_header(cfg)
+            width, angle = read_from_fits_header(cfg, frame.header)
             cfg.width = args.width if args.width else width
             cfg.angle = args.angle if args.angle else angle
         except Exception as e:
             pass
 
     fields = ["width", "height", "angle", "pixscale"]
-    terminate = False
-    for name in fields:
-        if cfg.__dict__[name] is None:
-            print(f'Missing input parameter {name}')
-            terminate = True
 
-    if terminate:
-        sys.exit(1)
-
-    return cfg
+    return [name for name in fields if cfg.__dict__[name] is None]
 
-def read_from_fits_header(cfg : Configuration):
-    from astropy.io import fits
+def read_from_fits_header(cfg : Configuration, hdr):
     import numpy as np
 
-    filename = cfg.input
-
-    hdul = fits.open(filename)
-    hdr = hdul[0].header
-
     exptime = float(hdr['EXPTIME'])
     cfg.pixscale = float(hdr['PIXSCALE'] if hdr['PIXSCALE'] is not None else cfg.pixscale)
     ratrack = float(hdr['RATRACK'])
@@ -3,7 +3,6 @@ from dataclasses import dataclass
 from typing import List, Tuple
 from abc import ABC, abstractmethod
 import numpy as np
-from utils import run_functions
 
 
 class DatabaseItem:
@@ -12,9 +11,11 @@ class DatabaseItem:
                  fwhm_x=np.inf, fwhm_y=np.inf, rms=np.inf, skew_x=np.inf, skew_y=np.inf,
                  kurt_x=np.inf, kurt_y=np.inf, bri_error=np.inf, x0_err=np.inf,
                  y0_err=np.inf, total_err=np.inf, is_line=False):
-        self.data = [cent_x, cent_y, snr, iter, sum, mean, var, std, skew, kurt, bckg,
-                     fwhm_x, fwhm_y, rms, skew_x, skew_y,
-                     kurt_x, kurt_y, x0_err, y0_err, total_err, bri_error, 1 if is_line else 0]
+        values = (cent_x, cent_y, snr, iter, sum, mean, var, std, skew, kurt, bckg,
+                  fwhm_x, fwhm_y, rms, skew_x, skew_y,
+                  kurt_x, kurt_y, x0_err, y0_err, total_err, bri_error, 1 if is_line else 0)
+        # missing values (None) are stored as NaN
+        self.data = np.array([np.nan if v is None else v for v in values], dtype=float)
 
 
 
@@ -25,84 +26,211 @@ class Database:
                 'x0_err', 'y0_err', 'total_err', 'bri_error', 'is_line') # 23 items
 
     def __init__(self, psf=False):
-        self.data = np.zeros((0, len(self.col_names))).astype(object)
+        # float64 storage with one row per column, rows of the database are appended as columns
+        # of the storage (capacity is doubled when full), removed rows are only marked
+        self.columns = np.zeros((len(self.col_names), 16))
+        self.removed = np.zeros(16, dtype=bool)
+        self.length = 0  # used part of the storage
+        self.count = 0  # number of rows which are not removed
+        self.cached = None  # rows as 2-D array, built on demand
+        self.text = None  # (rows, their columns as text) shared by the text writers
+        self.cells = {}  # grid cell -> positions of rows with the centre in the cell
+        self.cell_size = None
         self.psf_enabled = psf
 
+    def __getstate__(self):
+        # only the rows are sent to other processes (no free capacity, no removed rows, no index)
+        state = self.__dict__.copy()
+        state.update(columns=self.compacted(), removed=np.zeros(self.count, dtype=bool), length=self.count,
+                     cached=None, text=None, cells={}, cell_size=None)
+        return state
+
+    def compacted(self):
+        return self.columns[:, :self.length][:, np.logical_not(self.removed[:self.length])]
+
+    @property
+    def data(self):
+        if self.cached is None:
+            self.cached = np.ascontiguousarray(self.compacted().T)
+        return self.cached
+
+    @data.setter
+    def data(self, data):
+        data = np.asarray(data, dtype=float).reshape(-1, len(self.col_names))
+        self.columns = data.T.copy()
+        self.removed = np.zeros(len(data), dtype=bool)
+        self.length = len(data)
+        self.count = len(data)
+        self.cached = None
+        self.cells = {}
+        self.cell_size = None
+
+    def column(self, name):
+        # values of the column NAME (one of col_names) as float64 array
+        return self.data[:, self.col_names.index(name)]
+
+    def reserve(self, size):
+        capacity = self.columns.shape[1]
+        if size <= capacity:
+            return
+
+        capacity = max(size, 2 * capacity, 16)
+        columns = np.zeros((len(self.col_names), capacity))
+        columns[:, :self.length] = self.columns[:, :self.length]
+        removed = np.zeros(capacity, dtype=bool)
+        removed[:self.length] = self.removed[:self.length]
+
+        self.columns = columns
+        self.removed = removed
+
     def psf_data_mode(self):
         return not np.any(self.data[11:21] == np.inf)
 
     def nrows(self):
-        return self.data.shape[0]
+        return self.count
+
+    def cell(self, x, y):
+        return int(np.floor(x / self.cell_size)), int(np.floor(y / self.cell_size))
+
+    def index_row(self, i):
+        x, y = self.columns[0, i], self.columns[1, i]
+        # rows with non finite centre are never close to any other row
+        if self.cell_size is not None and np.isfinite(x) and np.isfinite(y):
+            self.cells.setdefault(self.cell(x, y), []).append(i)
+
+    def build_index(self, cell_size):
+        # grid hash with cells of the size of the distance limit, close rows are in the 3x3 neighbourhood
+        self.cell_size = cell_size
+        self.cells = {}
+        for i in np.flatnonzero(np.logical_not(self.removed[:self.length])):
+            self.index_row(i)
+
+    def find_close(self, x, y, thrs):
+        # positions (in the order of insertion) of rows with the centre closer than THRS to X, Y
+        if not thrs > 0 or not (np.isfinite(x) and np.isfinite(y)):
+            return np.zeros(0, dtype=int)
+
+        if self.cell_size != thrs:
+            self.build_index(thrs)
+
+        cx, cy = self.cell(x, y)
+        ids = [i for dx in (-1, 0, 1) for dy in (-1, 0, 1) for i in self.cells.get((cx + dx, cy + dy), ())]
+        if len(ids) == 0:
+            return np.zeros(0, dtype=int)
+        ids = np.sort(np.array(ids, dtype=int))
+
+        dist = np.sqrt((self.columns[0, ids] - x) ** 2 + (self.columns[1, ids] - y) ** 2)
+
+        return ids[dist < thrs]
+
+    def remove(self, ids):
+        for i in ids:
+            x, y = self.columns[0, i], self.columns[1, i]
+            if self.cell_size is not None and np.isfinite(x) and np.isfinite(y):
+                self.cells[self.cell(x, y)].remove(i)
+        self.removed[ids] = True
+        self.count -= len(ids)
+        self.cached = None
 
     def update(self, current: DatabaseItem, thrs):
 
-        current = current.data
+        if isinstance(current, DatabaseItem):
+            current = current.data
 
         if self.nrows() == 0:
             self.add(current)
             return -1
 
-        dist = np.array(
-            [np.sqrt((self.data[i][0] - current[0]) ** 2 + (self.data[i][1] - current[1]) ** 2) for i in
-             range(self.nrows())])
+        close_rows = self.find_close(current[0], current[1], thrs)
 
-        close_rows = dist < thrs
-
-        if np.sum(close_rows) == 0:
-            self.data = np.concatenate((self.data, [current]))
+        if len(close_rows) == 0:
+            self.add(current)
             return 0
 
-        d = np.concatenate((self.data[close_rows], [current]))
-        id = np.argmax(d[:, 3])
-        best = d[id]
+        # the close row (or the new one) with the most iterations is kept, it is moved to the end
+        iters = np.append(self.columns[3, close_rows], current[3])
+        id = np.argmax(iters)
+        best = self.columns[:, close_rows[id]].copy() if id < len(close_rows) else current
 
-        not_close_rows = np.logical_not(close_rows)
-        self.data = np.concatenate((self.data[not_close_rows], [best]))
+        self.remove(close_rows)
+        self.add(best)
 
         return 1
 
     def add(self, data):
         if isinstance(data, DatabaseItem):
             data = data.data
-        self.data = np.concatenate((self.data, [data]))
 
-    def concatenate(self, other):
+        self.reserve(self.length + 1)
+        self.columns[:, self.length] = data
+        self.length += 1
+        self.count += 1
+        self.cached = None
+        self.index_row(self.length - 1)
+
+    def shift(self, dx, dy):
+        # moves the centres by DX, DY (from coordinates of a part of the image to the image)
+        self.columns[0, :self.length] += dx
+        self.columns[1, :self.length] += dy
+        self.cached = None
+        if self.cell_size is not None:
+            self.build_index(self.cell_size)
+
+    def concatenate(self, *others):
+        # rows of this database followed by the rows of OTHERS, storages are joined with one copy
         new = Database()
-        new.data = np.concatenate((self.data, other.data))
+        new.data = np.concatenate([self.compacted()] + [other.compacted() for other in others], axis=1).T
 
         return new
 
+    def text_columns(self):
+        # columns of the rows as text, converted once for all text outputs of unchanged rows
+        data = self.data
+        if self.text is None or self.text[0] is not data:
+            self.text = (data, run_functions.text_columns(data))
+        return self.text[1]
+
     def write_tsv(self, filename):
 
         sorted_idx = np.argsort(self.data[:, 0])
 
-        ordered = self.data[sorted_idx].astype("U30") # [:,:11].
+        ordered = self.data[sorted_idx]
+        text = self.text_columns()
+        order = sorted_idx.tolist()
+        columns = [[text[i][k] for k in order] for i in range(11)]
 
         if self.psf_data_mode():
-            ordered[:, 9] =  list(map(lambda x: f'{x[0]}|{x[1]}', ordered[:,16:18]))
+            columns[9] = [f'{text[16][k]}|{text[17][k]}' for k in order]
 
         # add flag s if the object is a line
-        ordered[:,9] = list(map(lambda x: f'{x[9][:28]}{"|s" if float(x[22]) == 1 else ""}', ordered))
-
-        ordered = ordered[:,:11]
+        columns[9] = [f'{x[:28]}{"|s" if line else ""}' for x, line in zip(columns[9], ordered[:, 22] == 1)]
 
-        filename = filename
         col_names = self.col_names[:11]
 
-        run_functions.write_tsv(filename, col_names, ordered)
+        run_functions.write_tsv_columns(filename, col_names, columns)
 
     def compute_brightness_error(self, n_ipx, n_b):
         return
 
     def size(self):
-        return len(self.data)
+        return self.nrows()
 
     def write_json(self, filename):
-        tmp = self.data.copy().astype(object)
+        columns = list(self.text_columns())
         if self.psf_data_mode():
-            tmp[:, [3, 5, 6, 7, 8, 9]] = None
+            for i in [3, 5, 6, 7, 8, 9]:
+                columns[i] = ['None'] * len(self.data)
+
+        run_functions.write_json_columns(filename, self.col_names, columns)
 
-        run_functions.write_json(filename,self.col_names, tmp)
+    def write_npy(self, filename):
+        # all columns in the order of the database, missing values are NaN
+        run_functions.write_npy(filename, self.col_names, self.data)
+
+    def write_catalog(self, filename, formats):
+        writers = {'tsv': self.write_tsv, 'json': self.write_json, 'npy': self.write_npy}
+        for name in formats:
+            writers[name](filename)
 
 @dataclass
 class WrapperResult:
@@ -132,6 +260,7 @@ class Stats:
     lowsnr: int = 0
     ok: int = 0
     notright: int = 0
+    fitbudget: int = 0
 
 
 @dataclass
@@ -139,6 +268,7 @@ class SerialResult:
     database: Database
     discarded: Database
     stats: Stats
+    first_centroid: float = None  # time.time() when the first object was kept
 
     def print_stats(self):
         print('\n-------- Stats ------------\n')
@@ -152,6 +282,7 @@ class SerialResult:
         print(f'   Min iter       : {self.stats.miniter}')
         print(f'   Low SNR        : {self.stats.lowsnr}')
         print(f'   Not right      : {self.stats.notright}')
+        print(f'   Fit budget     : {self.stats.fitbudget}')
 
 
 @dataclass
@@ -162,8 +293,23 @@ class GravityCentreResult:
     Z_pixels: np.ndarray
 
 
+@dataclass
+class GravityCentreBatchResult:
+    center_x: np.ndarray  # NaN for empty boxes
+    center_y: np.ndarray
+    count: np.ndarray  # number of pixels in each box
+    sum_Z: np.ndarray  # sum of Z pixels of each box
+    summed: np.ndarray  # boxes computed from an integral image (their pixels are not extracted)
+    X_pixels: np.ndarray
+    Y_pixels: np.ndarray
+    Z_pixels: np.ndarray
+    index: np.ndarray  # box of each pixel
+
+
 @dataclass
 class Report:
+    col_names = ('cent.x', 'cent.y', 'sum', 'cat.x', 'cat.y', 'cat.sum')
+
     matched: np.ndarray
     unmatched: np.ndarray
     model: np.ndarray
@@ -184,29 +330,29 @@ class Report:
             print(f'\tRMS Y: {self.rms_y:.4f}')
         print()
 
-    def write_tsv(self, filename, database):
+    def matched_data(self, database):
 
-        data = np.ones((0,6))
+        data = np.ones((0, 6))
         if len(self.matched) > 0:
             matched_database = database.data[self.matched[:, 0]][:, [0, 1, 4]]
-            matched_model = self.model[self.matched[:, 1]]
+            matched_model = self.model[self.matched[:, 1]][:, :3]  # x, y, sum of wider model catalogs
             data = np.concatenate((matched_database, matched_model), axis=1)
 
-        col_names = ('cent.x', 'cent.y', 'sum', 'cat.x', 'cat.y', 'cat.sum')
-        run_functions.write_tsv(filename+'_matched', col_names, data.astype(np.float32))
+        return data
 
+    def write_tsv(self, filename, database):
+        run_functions.write_tsv(filename + '_matched', self.col_names, self.matched_data(database).astype(np.float32))
 
     def write_json(self, filename, database):
+        run_functions.write_json(filename + '_matched', self.col_names, self.matched_data(database))
 
-        data = np.ones((0, 6))
-        if len(self.matched) > 0:
-            matched_database = database.data[self.matched[:, 0]][:, [0, 1, 4]]
-            matched_model = self.model[self.matched[:, 1]]
-            data = np.concatenate((matched_database, matched_model), axis=1)
-
-        col_names = ('cent.x', 'cent.y', 'sum', 'cat.x', 'cat.y', 'cat.sum')
+    def write_npy(self, filename, database):
+        run_functions.write_npy(filename + '_matched', self.col_names, self.matched_data(database))
 
-        run_functions.write_json(filename + '_matched', col_names, data)
+    def write_catalog(self, filename, database, formats):
+        writers = {'tsv': self.write_tsv, 'json': self.write_json, 'npy': self.write_npy}
+        for name in formats:
+            writers[name](filename, database)
 
 
 @dataclass
@@ -240,6 +386,19 @@ class Configuration:
     psf: bool
     pixscale: float
     field_rotation_angle: float
+    batch_size: int = 4096
+    integral_image: bool = False
+    halo: float = None
+    workers: int = None
+    tile_size: int = None
+    max_order: str = 'raster'
+    bkg_method: str = 'sigma'
+    bkg_box: int = 64
+    bkg_cache: str = None
+    fit_budget: int = 10000
+    sections: bool = False
+    report: str = 'sync'
+    catalog: str = 'tsv,json'
 
     def to_json(self):
         return json.dumps(self.__dict__)
@@ -248,3 +407,7 @@ class Configuration:
     def from_json(cls, json_string):
         json_dict = json.loads(json_string)
         return cls(**json_dict)
+
+
+# imported after the structures, run_functions uses them at import time
+from utils import run_functions